@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from compose_frames import compose_frames
+from mutants import MutantSet, structure_file
+from pdb_reader import read_ca_coords, read_ca_coords_parallel
+from render_mutation_matrices import draw_amino_acid_labels, draw_legend, render_matrix_base, render_matrix_frames
+from structure_similarity import SCORING_BATCH_SIZE, get_mutation_matrix, lddt_scores, neighbor_pairs
+from video import encode_png_frames
+
+
+THREE_LETTER_CODES = {"A": "ALA", "C": "CYS", "D": "ASP", "E": "GLU", "F": "PHE", "G": "GLY", "H": "HIS", "I": "ILE", "K": "LYS", "L": "LEU",
+                      "M": "MET", "N": "ASN", "P": "PRO", "Q": "GLN", "R": "ARG", "S": "SER", "T": "THR", "V": "VAL", "W": "TRP", "Y": "TYR"}
+
+# backbone atoms relative to the C-alpha atom, enough for PyMOL to draw a cartoon
+BACKBONE_OFFSETS = (("N", (-1.2, 0.5, 0.0)), ("CA", (0.0, 0.0, 0.0)), ("C", (1.2, 0.5, 0.0)), ("O", (1.6, 1.6, 0.0)))
+
+
+def benchmark_sequences(fasta_file, lengths=None):
+    """ Returns (identifier, sequence) tuples of the benchmark set. If lengths are
+        given, one sequence is derived per length from the benchmark record with
+        the closest length, truncated or repeated to the requested length.
+    """
+    records = [(record.id, str(record.seq)) for record in SeqIO.parse(fasta_file, "fasta")]
+    if lengths is None:
+        return records
+
+    sequences = []
+    for length in lengths:
+        id, seq = min(records, key=lambda record: abs(len(record[1]) - length))
+        seq = (seq * (length // len(seq) + 1))[:length]
+        sequences.append(("{}_L{}".format(id, length), seq))
+    return sequences
+
+
+def write_pdb(filename, seq, ca_coords, b_factors):
+    with open(filename, "w") as f:
+        atom = 1
+        for i, aa in enumerate(seq):
+            for name, offset in BACKBONE_OFFSETS:
+                x, y, z = ca_coords[i] + offset
+                f.write("ATOM  {:5d}  {:<3s} {:3s} A{:4d}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}           {}\n".format(atom, name, THREE_LETTER_CODES[aa], i+1, x, y, z, 1.0, b_factors[i], name[0]))
+                atom += 1
+        f.write("TER\nEND\n")
+
+
+def generate_structures(id, seq, mutants, pdb_dir, seed=0):
+    """ Writes a synthetic wild-type structure (a random C-alpha walk) and one
+        structure per mutant, in which the residues around the mutated position
+        are displaced and the whole chain is rotated and translated.
+    """
+    rng = np.random.default_rng(seed)
+    length = len(seq)
+
+    steps = rng.normal(size=(length, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=1)[:, None]
+    wt_coords = np.cumsum(steps, axis=0)
+    write_pdb(os.path.join(pdb_dir, "{}.pdb".format(id)), seq, wt_coords, rng.uniform(30, 100, length))
+
+    for mutant in mutants:
+        mut_seq = seq[:mutant.position] + mutant.aa + seq[mutant.position+1:]
+        displacement = np.exp(-np.abs(np.arange(length) - mutant.position) / 5.0)[:, None] * rng.normal(scale=rng.uniform(0.5, 5.0), size=(length, 3))
+        rotation = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        coords = (wt_coords + displacement) @ rotation.T + rng.normal(scale=10.0, size=3)
+        write_pdb(structure_file(id, mutant, pdb_dir), mut_seq, coords, rng.uniform(30, 100, length))
+
+
+def placeholder_3d_frames(id, mutants, png_dir, width, height):
+    """ Stands in for the PyMOL renderings when PyMOL is not installed, so that
+        the later stages can still be measured.
+    """
+    from PIL import Image
+
+    for mutant in mutants:
+        Image.new("RGB", (width, height), (255, 255, 255)).save(os.path.join(png_dir, "{}_{}.png".format(id, mutant.name)))
+
+
+def time_stage(results, stage, items, func, *args, **kwargs):
+    """ Runs a single stage with its progress output suppressed and records the
+        wall time in results.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        value = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start_time
+    results[stage] = {"seconds": elapsed, "items": items, "items_per_second": items / elapsed if elapsed > 0 else None}
+    print("  {:<16s} {:10.3f} s  {:10.1f} items/s".format(stage, elapsed, results[stage]["items_per_second"] or 0.0))
+    return value
+
+
+def score_coords(wt_coords, coords, batch_size=SCORING_BATCH_SIZE):
+    pairs = neighbor_pairs(wt_coords)
+    scores = []
+    for start in range(0, len(coords), batch_size):
+        scores.append(lddt_scores(pairs, np.stack(coords[start:start+batch_size])))
+    return np.concatenate(scores)
+
+
+def benchmark_sequence(id, seq, work_dir, args):
+    movie_height = args.height
+    movie_width = int(movie_height * 16 / 9)
+    scale_factor = movie_height / 360
+    matrix_frame_width = int(200 * scale_factor)
+    matrix_margin_horizontal = int(5 * scale_factor)
+    matrix_margin_vertical = int(10 * scale_factor)
+
+    positions = None
+    if args.positions > 0 and args.positions < len(seq):
+        positions = set(np.linspace(0, len(seq) - 1, args.positions).astype(int).tolist())
+    mutants = MutantSet(seq, positions)
+
+    pdb_dir = os.path.join(work_dir, id, "predictions")
+    png_dir = os.path.join(work_dir, id, "png")
+    mut_matrices_dir = os.path.join(work_dir, id, "mut_matrices_png")
+    composite_dir = os.path.join(work_dir, id, "composite_png")
+    for directory in (pdb_dir, png_dir, mut_matrices_dir, composite_dir):
+        os.makedirs(directory)
+
+    print("{} (length {}, {} mutants)".format(id, len(seq), len(mutants)))
+    generate_structures(id, seq, mutants, pdb_dir, seed=args.seed)
+    pdb_files = [structure_file(id, mutant, pdb_dir) for mutant in mutants]
+
+    stages = {}
+    parsed = time_stage(stages, "parse", len(pdb_files), lambda: list(read_ca_coords_parallel(pdb_files, len(seq), args.jobs)))
+    wt_coords = read_ca_coords(os.path.join(pdb_dir, "{}.pdb".format(id)), len(seq))[0]
+    time_stage(stages, "score", len(parsed), score_coords, wt_coords, [result[0] for result in parsed])
+
+    # end-to-end scoring including parsing and the similarity cache, once cold and once warm
+    time_stage(stages, "similarity", len(mutants), get_mutation_matrix, id, list(seq), pdb_dir, None, None, jobs=args.jobs, mutants=mutants)
+    mut_matrix = time_stage(stages, "similarity_warm", len(mutants), get_mutation_matrix, id, list(seq), pdb_dir, None, None, jobs=args.jobs, mutants=mutants)
+
+    legend = draw_legend(scale_factor)
+    aa_labels = draw_amino_acid_labels(scale_factor)
+    matrix_frames = time_stage(stages, "matrix_base", 1, render_matrix_base, list(seq), mut_matrix, legend, aa_labels, movie_height, matrix_frame_width, matrix_margin_horizontal, matrix_margin_vertical, scale_factor)
+    time_stage(stages, "matrix_frames", len(mutants), render_matrix_frames, id, list(seq), matrix_frames, mut_matrices_dir, None, mutants=mutants)
+
+    if args.pymol and importlib.util.find_spec("pymol") is not None:
+        from render_3d_frames import render_3d_frames
+
+        time_stage(stages, "render_3d", len(mutants), render_3d_frames, id, list(seq), pdb_dir, png_dir, movie_width - matrix_frame_width, movie_height, scale_factor, jobs=args.jobs, mutants=mutants)
+    else:
+        placeholder_3d_frames(id, mutants, png_dir, movie_width - matrix_frame_width, movie_height)
+
+    time_stage(stages, "compose", len(mutants), compose_frames, id, list(seq), movie_width, movie_height, matrix_frame_width, mut_matrices_dir, png_dir, composite_dir, None, mutants=mutants)
+
+    if shutil.which("ffmpeg") is not None:
+        time_stage(stages, "encode", len(mutants), encode_png_frames, composite_dir, 19, os.path.join(work_dir, id, "{}.mp4".format(id)))
+
+    return {"id": id, "length": len(seq), "mutants": len(mutants), "stages": stages}
+
+
+def git_revision():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare_results(results, baseline_file):
+    """ Prints the change of every stage relative to a previous benchmark run. """
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    previous = {(entry["id"], entry["mutants"]): entry["stages"] for entry in baseline["results"]}
+
+    print("Comparison with {} (commit {})".format(baseline_file, baseline.get("commit")))
+    for entry in results:
+        stages = previous.get((entry["id"], entry["mutants"]))
+        if stages is None:
+            continue
+        for stage, result in entry["stages"].items():
+            if stage in stages and stages[stage]["seconds"] > 0:
+                ratio = result["seconds"] / stages[stage]["seconds"]
+                print("  {:<20s} {:<16s} {:10.3f} s -> {:10.3f} s  ({:+.1f}%)".format(entry["id"], stage, stages[stage]["seconds"], result["seconds"], (ratio - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='run_benchmark',
+                    description='Measures the individual MutAmore stages on synthetic mutant structures')
+
+    parser.add_argument('-i', '--input_fasta', type=str, help="Benchmark sequences (default: benchmark/benchmark_set.fasta)", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "benchmark_set.fasta"))
+    parser.add_argument('-o', '--output', type=str, help="Output JSON file (default: benchmark_results.json)", default="benchmark_results.json")
+    parser.add_argument('--lengths', type=str, help="Comma-separated sequence lengths to benchmark instead of the benchmark set, e.g. 100,300,600")
+    parser.add_argument('--positions', type=int, help="Number of evenly spaced positions scanned per sequence, 0 for all (default: 10)", default=10)
+    parser.add_argument('--height', type=int, help="Movie vertical resolution (default: 720)", default=720)
+    parser.add_argument('-j', '--jobs', type=int, help="Number of parallel worker processes (default: 1)", default=1)
+    parser.add_argument('--seed', type=int, help="Seed for the synthetic structures (default: 0)", default=0)
+    parser.add_argument('--no-pymol', dest="pymol", action="store_false", help="Skip the PyMOL rendering stage even if PyMOL is installed")
+    parser.add_argument('--work_dir', type=str, help="Directory in which every run keeps its synthetic structures and frames in a new subdirectory (default: a temporary directory that is removed afterwards)")
+    parser.add_argument('--compare', type=str, help="Previous benchmark JSON file to compare the results with")
+    args = parser.parse_args()
+
+    lengths = None
+    if args.lengths:
+        lengths = [int(length) for length in args.lengths.split(",")]
+    sequences = benchmark_sequences(args.input_fasta, lengths)
+
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="mutamore_benchmark_")
+    else:
+        # a fresh directory for every run, files of earlier runs would skip or speed up stages
+        if not os.path.isdir(args.work_dir):
+            os.makedirs(args.work_dir)
+        work_dir = tempfile.mkdtemp(prefix="run_", dir=args.work_dir)
+        print("Keeping the files of this run in {}".format(work_dir))
+
+    results = []
+    try:
+        for id, seq in sequences:
+            results.append(benchmark_sequence(id, seq, work_dir, args))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    commit, dirty = git_revision()
+    report = {"commit": commit,
+              "dirty": dirty,
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "parameters": {"positions": args.positions, "height": args.height, "jobs": args.jobs, "seed": args.seed},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,77 @@
 import time
 import os
 from PIL import Image
+from manifest import signature
+from mutants import MutantSet
 from progressBar import *
+from utils import INTERMEDIATE_PNG_COMPRESSION
 
 
-def compose_frames(id, seq, movie_width, movie_height, matrix_frame_width, mut_matrices_dir, png_dir, composite_dir, topN_indices):
+def compose_frame(img_3d, img_mut_matrix, movie_width, movie_height, matrix_frame_width):
+    tar_img = Image.new('RGB', (movie_width, movie_height), (255, 255, 255))
+    tar_img.paste(img_3d, (0, 0))
+    tar_img.paste(img_mut_matrix, (movie_width - matrix_frame_width, 0))
+    return tar_img
+
+
+def remove_files(*filenames):
+    for filename in filenames:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def compose_frames(id, seq, movie_width, movie_height, matrix_frame_width, mut_matrices_dir, png_dir, composite_dir, topN_indices, manifest=None, mutants=None, first_frame=0, trim=True, remove_inputs=False):
+    """ Composes the frames of the selected mutants, numbered from first_frame.
+        With trim, frames left over from a previous run with more frames are removed.
+        With remove_inputs, the 3D and mutation matrix frames are deleted once
+        they have been composed.
+    """
     start_time = time.time()
-    total = len(seq) * 19
+    if mutants is None:
+        mutants = MutantSet(seq)
+    total = len(mutants)
     printProgressBar(0, total, prefix='Composing final frames:', suffix='Complete', length=50)
-    outputIndex = 0
-    counter = 0
-    aa_list = list("ACDEFGHIKLMNPQRSTVWY")
-    for i in range(len(seq)):
-        for aa in list("ACDEFGHIKLMNPQRSTVWY"):
-            if aa == seq[i]:
-                continue
-            if topN_indices is not None and topN_indices[aa_list.index(aa), i] == False:
+    outputIndex = first_frame
+    counter = total - len(mutants.selected(topN_indices))
+    for mutant in mutants.selected(topN_indices):
+        composite_file = os.path.join(composite_dir, "{}.png".format(outputIndex))
+        outputIndex += 1
+
+        png_file = os.path.join(png_dir, "{}_{}.png".format(id, mutant.name))
+        mut_matrix_file = os.path.join(mut_matrices_dir, "{}_matrix_{}.png".format(id, mutant.name))
+
+        if manifest is not None:
+            key = signature(manifest.get("3d", png_file), manifest.get("matrix", mut_matrix_file), movie_width, movie_height, matrix_frame_width)
+            if manifest.is_current("composite", composite_file, key):
+                if remove_inputs:
+                    remove_files(png_file, mut_matrix_file)
                 counter += 1
                 printProgressBar(counter, total, prefix='Composing final frames:', suffix='Complete', length=50)
                 continue
-            temp_seq = seq.copy()
-            temp_seq[i] = aa
 
-            composite_file = os.path.join(composite_dir, "{}.png".format(outputIndex))
-            outputIndex += 1
+        img_3d = Image.open(png_file)
+        img_mut_matrix = Image.open(mut_matrix_file)
 
-            png_file = os.path.join(png_dir, "{}_{}{}{}.png".format(id, seq[i], i + 1, aa))
-            img_3d = Image.open(png_file)
+        tar_img = compose_frame(img_3d, img_mut_matrix, movie_width, movie_height, matrix_frame_width)
+        tar_img.save(composite_file, compress_level=INTERMEDIATE_PNG_COMPRESSION)
+        if manifest is not None:
+            manifest.record("composite", composite_file, key)
+        if remove_inputs:
+            img_3d.close()
+            img_mut_matrix.close()
+            remove_files(png_file, mut_matrix_file)
 
-            mut_matrix_file = os.path.join(mut_matrices_dir, "{}_matrix_{}{}{}.png".format(id, seq[i], i + 1, aa))
-            img_mut_matrix = Image.open(mut_matrix_file)
+        counter += 1
+        printProgressBar(counter, total, prefix='Composing final frames:', suffix='Complete', length=50)
 
-            tar_img = Image.new('RGB', (movie_width, movie_height), (255, 255, 255))
-            tar_img.paste(img_3d, (0, 0))
-            tar_img.paste(img_mut_matrix, (movie_width - matrix_frame_width, 0))
-            tar_img.save(composite_file)
+    # remove frames left over from a previous run with more frames, ffmpeg would pick them up
+    while trim and os.path.isfile(os.path.join(composite_dir, "{}.png".format(outputIndex))):
+        os.remove(os.path.join(composite_dir, "{}.png".format(outputIndex)))
+        outputIndex += 1
 
-            counter += 1
-            printProgressBar(counter, total, prefix='Composing final frames:', suffix='Complete', length=50)
+    if manifest is not None:
+        manifest.save()
 
     end_time = time.time()
     print("Elapsed time: {}".format(end_time - start_time))
+
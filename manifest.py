@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return "{}:{}".format(st.st_size, st.st_mtime_ns)
+
+
+def signature(*parts):
+    """ Combines input signatures and rendering parameters into a single key. """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class BuildManifest:
+    """ Keeps track of which outputs of the rendering stages were produced from
+        which inputs and parameters, so that reruns only regenerate stale outputs.
+        Outputs are identified per stage by their file name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.stages = json.load(f)
+
+    def get(self, stage, output):
+        return self.stages.get(stage, {}).get(os.path.basename(output))
+
+    def is_current(self, stage, output, key):
+        return os.path.isfile(output) and self.get(stage, output) == key
+
+    def record(self, stage, output, key):
+        self.stages.setdefault(stage, {})[os.path.basename(output)] = key
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f)
+        os.replace(tmp_path, self.path)
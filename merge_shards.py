@@ -0,0 +1,107 @@
+import argparse
+import glob
+import os
+import re
+import shutil
+import tempfile
+from Bio import SeqIO
+from utils import movie_framerate, shard_movie_file
+from video import EncoderProfile, concat_movies, count_png_frames, encode_png_frames
+
+
+def find_shard_movies(output_dir, name):
+    """ Returns the shard movies of a movie in frame order, or None if shards are missing. """
+    pattern = re.compile(r"^{}_shard(\d+)of(\d+)\.mp4$".format(re.escape(name)))
+    shards = {}
+    for filename in glob.glob(os.path.join(glob.escape(output_dir), "{}_shard*of*.mp4".format(glob.escape(name)))):
+        match = pattern.match(os.path.basename(filename))
+        if match is not None:
+            shards[(int(match.group(1)), int(match.group(2)))] = filename
+    counts = set(n for k, n in shards)
+    if len(counts) != 1:
+        return None
+    n = counts.pop()
+    if any((k, n) not in shards for k in range(1, n + 1)):
+        return None
+    return [shard_movie_file(output_dir, name, (k, n)) for k in range(1, n + 1)]
+
+
+def merge_movies(input_fasta, output_dir, draft=False, remove=False):
+    """ Joins the shard movies of every record without re-encoding. """
+    for record in SeqIO.parse(input_fasta, "fasta"):
+        name = "{}_draft".format(record.id) if draft else record.id
+        shard_files = find_shard_movies(output_dir, name)
+        if shard_files is None:
+            print("ERROR: Shard movies of {} are missing or inconsistent in {}".format(name, output_dir))
+            continue
+        out_file = os.path.join(output_dir, "{}.mp4".format(name))
+        concat_movies(shard_files, out_file)
+        print("Merged {} shards into {}".format(len(shard_files), out_file))
+        if remove:
+            for filename in shard_files:
+                os.remove(filename)
+
+
+def merge_frames(frame_dirs, out_file, framerate, profile, segments=1):
+    """ Encodes the composed frames of all shards, collected from one or more
+        directories, into a single movie.
+    """
+    merged_dir = tempfile.mkdtemp(prefix="merged_frames_", dir=os.path.dirname(os.path.abspath(out_file)))
+    try:
+        available = 0
+        for frame_dir in frame_dirs:
+            for file_name in os.listdir(frame_dir):
+                index = file_name[:-4]
+                if not file_name.endswith(".png") or not index.isdigit():
+                    continue
+                merged_file = os.path.join(merged_dir, "{}.png".format(int(index)))
+                if os.path.isfile(merged_file):
+                    continue
+                try:
+                    os.link(os.path.join(frame_dir, file_name), merged_file)
+                except OSError:
+                    shutil.copyfile(os.path.join(frame_dir, file_name), merged_file)
+                available += 1
+
+        frames = count_png_frames(merged_dir)
+        if frames < available:
+            print("ERROR: Frame {} is missing, please check that the frames of all shards were collected".format(frames))
+            quit()
+        encode_png_frames(merged_dir, framerate, out_file, profile, segments)
+        print("Merged {} frames into {}".format(frames, out_file))
+    finally:
+        shutil.rmtree(merged_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='merge_shards',
+                    description='Joins the parts of movies rendered on several hosts with --shard')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    movies_parser = subparsers.add_parser("movies", help="Join the shard movies <ID>_shard<K>of<N>.mp4 of every record without re-encoding")
+    movies_parser.add_argument('-i', '--input_fasta', type=str, help="Input FASTA file", required=True)
+    movies_parser.add_argument('-o', '--output_dir', type=str, help="Directory with the shard movies, the merged movies are written there (default: current working directory)", default="./")
+    movies_parser.add_argument('--draft', action="store_true", help="Join draft movies")
+    movies_parser.add_argument('--remove', action="store_true", help="Delete the shard movies after joining them")
+
+    frames_parser = subparsers.add_parser("frames", help="Encode the composed frames of all shards into one movie")
+    frames_parser.add_argument('frame_dirs', nargs="+", help="Directories with the composed frames of the shards (composite_png)")
+    frames_parser.add_argument('-o', '--out_file', type=str, help="Output movie", required=True)
+    frames_parser.add_argument('--top', type=int, help="Number of top-N mutants the frames were rendered with, which sets the frame rate")
+    frames_parser.add_argument('--codec', type=str, help="ffmpeg video codec (default: libx264)", default="libx264")
+    frames_parser.add_argument('--preset', type=str, help="Encoder preset, e.g. ultrafast or slow for libx264 (default: codec default)")
+    frames_parser.add_argument('--crf', type=int, help="Constant rate factor of the encoder, lower values give a higher quality (default: 25)", default=25)
+    frames_parser.add_argument('--encoder_threads', type=int, help="Number of threads of every ffmpeg encoder (default: chosen by ffmpeg)")
+    frames_parser.add_argument('--encode_segments', type=int, help="Encode the movie as N segments in parallel, which are joined without re-encoding (default: 1)", default=1)
+    args = parser.parse_args()
+
+    if args.command == "movies":
+        merge_movies(args.input_fasta, args.output_dir, args.draft, args.remove)
+    elif args.command == "frames":
+        profile = EncoderProfile(args.codec, args.preset, args.crf, args.encoder_threads)
+        merge_frames(args.frame_dirs, args.out_file, movie_framerate(args.top), profile, args.encode_segments)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def directory_size(directory):
+    """ Total size of all files below directory in bytes. """
+    if directory is None or not os.path.isdir(directory):
+        return 0
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+# interval in seconds at which the memory of worker processes is sampled during a stage
+RSS_SAMPLE_INTERVAL = 0.2
+
+
+def _proc_status_bytes(pid, field):
+    """ Memory field (e.g. VmRSS or VmHWM) of a process from /proc in bytes, or None. """
+    try:
+        with open("/proc/{}/status".format(pid), "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _descendants(pid):
+    """ Process IDs of all running descendants of a process, found via /proc. """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), "r") as f:
+                # the command name in parentheses may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    descendants = []
+    stack = [pid]
+    while len(stack) > 0:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+    return descendants
+
+
+def _reset_peak_rss():
+    """ Resets the peak resident set size (VmHWM) of this process, only
+        possible on Linux. Returns whether it was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class PeakRss:
+    """ Measures the peak resident set size of a stage in bytes, both of this
+        process and of the sum of its worker processes (children_bytes). On
+        Linux, the peak of this process is reset at the start of the stage and
+        the worker processes are sampled every RSS_SAMPLE_INTERVAL seconds, so
+        short-lived peaks of workers can be missed. Elsewhere, both values are
+        the peaks since the start of the process (ru_maxrss), which include
+        earlier stages.
+    """
+
+    def __init__(self):
+        self.per_stage = os.path.isdir("/proc/self")
+        self.reset = self.per_stage and _reset_peak_rss()
+        self.self_bytes = 0
+        self.children_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if self.per_stage:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            self.self_bytes = max(self.self_bytes, _proc_status_bytes(pid, "VmRSS") or 0)
+            children = sum(_proc_status_bytes(child, "VmRSS") or 0 for child in _descendants(pid))
+            self.children_bytes = max(self.children_bytes, children)
+            if self._stop.wait(RSS_SAMPLE_INTERVAL):
+                return
+
+    def stop(self):
+        """ Returns the peaks of this process and of its worker processes. """
+        if not self.per_stage:
+            # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+            unit = 1 if sys.platform == "darwin" else 1024
+            return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+        self._stop.set()
+        self._thread.join()
+        if self.reset:
+            self.self_bytes = max(self.self_bytes, _proc_status_bytes(os.getpid(), "VmHWM") or 0)
+        return self.self_bytes, self.children_bytes
+
+
+class MetricsLog:
+    """ Writes one JSON object per line for every measured stage, with its wall
+        time, throughput, peak memory and the bytes it added to a directory. If a
+        profile directory is set, every stage is also run under cProfile and the
+        statistics are saved as <ID>_<STAGE>.prof (worker processes are not
+        included in the profile).
+    """
+
+    def __init__(self, path=None, profile_dir=None):
+        self.path = path
+        self.profile_dir = profile_dir
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    def event(self, event, **fields):
+        if self.path is None:
+            return
+        fields = dict(event=event, time=time.time(), **fields)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(fields) + "\n")
+
+    @contextmanager
+    def stage(self, stage, id=None, directory=None):
+        """ Measures the enclosed block. The yielded dictionary can be used to
+            report the number of processed items (e.g. frames) and further fields.
+        """
+        fields = {}
+        size_before = directory_size(directory) if self.path is not None else 0
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        rss = PeakRss() if self.path is not None else None
+        start_time = time.perf_counter()
+        status = "ok"
+        try:
+            yield fields
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            if profiler is not None:
+                profiler.disable()
+                profile_name = "{}_{}.prof".format(id, stage) if id is not None else "{}.prof".format(stage)
+                profiler.dump_stats(os.path.join(self.profile_dir, profile_name))
+
+            if self.path is not None:
+                rss_self, rss_children = rss.stop()
+                items = fields.pop("items", None)
+                size_after = directory_size(directory) if directory is not None else None
+                self.event("stage", stage=stage, id=id, status=status, seconds=elapsed,
+                           items=items, items_per_second=items / elapsed if items and elapsed > 0 else None,
+                           peak_rss_bytes=rss_self, peak_rss_children_bytes=rss_children,
+                           directory_bytes=size_after, bytes_written=size_after - size_before if directory is not None else None,
+                           **fields)
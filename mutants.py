@@ -0,0 +1,185 @@
+import copy
+import os
+from collections import namedtuple
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+class Mutant(namedtuple("Mutant", ["position", "wt", "aa"])):
+    """ Single amino-acid substitution at the 0-based sequence position. """
+
+    @property
+    def name(self):
+        return "{}{}{}".format(self.wt, self.position+1, self.aa)
+
+    @property
+    def cell(self):
+        """ Index of the mutant in the 20 x L mutation matrix. """
+        return AMINO_ACIDS.index(self.aa), self.position
+
+
+def parse_mutation(name):
+    if len(name) < 3 or not name[1:-1].isdigit() or name[0] not in AMINO_ACIDS or name[-1] not in AMINO_ACIDS:
+        raise ValueError("Invalid mutation {}, expected e.g. L32K".format(name))
+    if int(name[1:-1]) < 1:
+        raise ValueError("Invalid mutation {}, positions start at 1".format(name))
+    if name[0] == name[-1]:
+        raise ValueError("Invalid mutation {}, the amino acid is not substituted".format(name))
+    return Mutant(int(name[1:-1])-1, name[0], name[-1])
+
+
+def parse_positions(spec, length):
+    """ Parses 1-based position ranges such as "10-50,70" into a set of 0-based positions. """
+    positions = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start) if start.strip() != "" else 1
+            end = int(end) if end.strip() != "" else length
+        else:
+            start = end = int(part)
+        if start < 1 or end > length or start > end:
+            raise ValueError("Invalid position range {} for a sequence of length {}".format(part, length))
+        positions.update(range(start-1, end))
+    return positions
+
+
+def parse_targets(spec):
+    """ Parses target amino acids such as "AGP", in upper or lower case. """
+    targets = spec.strip().upper()
+    invalid = sorted(set(aa for aa in targets if aa not in AMINO_ACIDS))
+    if targets == "" or len(invalid) > 0:
+        raise ValueError("Invalid target amino acids {}, expected one-letter codes such as AGP".format(spec))
+    return targets
+
+
+def parse_shard(spec):
+    """ Parses a shard such as "2/4" into the 1-based shard number and the number of shards. """
+    try:
+        k, n = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard {}, expected e.g. 2/4".format(spec))
+    if n < 1 or k < 1 or k > n:
+        raise ValueError("Invalid shard {}, expected a number between 1 and {}".format(spec, n))
+    return k, n
+
+
+def read_mutation_list(filename):
+    """ Reads a list of mutations, one per line. A line can be prefixed by the
+        identifier of the FASTA record it applies to, otherwise it applies to all
+        records. Returns a list of (identifier or None, mutation name) tuples.
+    """
+    mutations = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line == "":
+                continue
+            parts = line.replace(",", " ").split()
+            if len(parts) == 1:
+                mutations.append((None, parts[0]))
+            else:
+                mutations.append((parts[0], parts[1]))
+    return mutations
+
+
+class MutantSet:
+    """ Ordered set of the mutants of a sequence that are predicted, scored and
+        rendered, by default all 19 substitutions at every position. The scan can
+        be restricted to positions, target residues or an explicit mutation list.
+    """
+
+    def __init__(self, seq, positions=None, targets=None, mutations=None):
+        self.seq = list(seq)
+        if mutations is not None:
+            wanted = set()
+            for name in mutations:
+                mutant = parse_mutation(name)
+                if mutant.position < 0 or mutant.position >= len(self.seq) or self.seq[mutant.position] != mutant.wt:
+                    raise ValueError("Mutation {} does not match the wild-type sequence".format(name))
+                wanted.add(mutant)
+
+        self.mutants = []
+        for i in range(len(self.seq)):
+            if positions is not None and i not in positions:
+                continue
+            for aa in AMINO_ACIDS:
+                if aa == self.seq[i]:
+                    continue
+                if targets is not None and aa not in targets:
+                    continue
+                mutant = Mutant(i, self.seq[i], aa)
+                if mutations is not None and mutant not in wanted:
+                    continue
+                self.mutants.append(mutant)
+        self.names = set(mutant.name for mutant in self.mutants)
+
+    def __iter__(self):
+        return iter(self.mutants)
+
+    def __len__(self):
+        return len(self.mutants)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def sample_positions(self, count):
+        """ Subset with the mutants at count evenly spaced positions of the scan,
+            e.g. for a quick preview.
+        """
+        positions = sorted(set(mutant.position for mutant in self.mutants))
+        if count >= len(positions):
+            return self
+        if count <= 1:
+            sampled = set(positions[len(positions) // 2:len(positions) // 2 + count])
+        else:
+            sampled = set(positions[round(k * (len(positions) - 1) / (count - 1))] for k in range(count))
+        return self.subset([mutant for mutant in self.mutants if mutant.position in sampled])
+
+    def subset(self, mutants):
+        subset = copy.copy(self)
+        subset.mutants = list(mutants)
+        subset.names = set(mutant.name for mutant in subset.mutants)
+        return subset
+
+    def selected(self, topN_indices):
+        """ Mutants shown in the movie, i.e. only the top-N mutants if selected. """
+        if topN_indices is None:
+            return list(self.mutants)
+        return [mutant for mutant in self.mutants if topN_indices[mutant.cell]]
+
+    def shard(self, topN_indices, shard):
+        """ Frames of one of several hosts rendering the same movie, given as
+            (k, N). Returns the index of the first frame of the shard and the
+            mutants of its contiguous range of frames. Frame indices only depend
+            on the mutant set and the top-N selection, so all shards together
+            cover the movie exactly once.
+        """
+        frames = self.selected(topN_indices)
+        k, n = shard
+        start, end = len(frames) * (k-1) // n, len(frames) * k // n
+        return start, self.subset(frames[start:end])
+
+
+def mutant_set_from_args(args, id, seq):
+    positions = None
+    if args.positions:
+        positions = parse_positions(args.positions, len(seq))
+    targets = None
+    if args.targets:
+        targets = parse_targets(args.targets)
+    mutations = None
+    if args.mutation_list:
+        mutations = [name for record_id, name in read_mutation_list(args.mutation_list) if record_id is None or record_id == id]
+    return MutantSet(seq, positions, targets, mutations)
+
+
+def structure_file(id, mutant, pdb_dir, experimental_mutations=None, experimental_dir=None):
+    """ PDB file of a mutant, which is either an experimental or a predicted structure. """
+    if experimental_mutations is not None and mutant.name in experimental_mutations:
+        return os.path.join(experimental_dir, mutant.name + ".pdb")
+    return os.path.join(pdb_dir, "{}_{}.pdb".format(id, mutant.name))
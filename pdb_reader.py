@@ -0,0 +1,89 @@
+import numpy as np
+from multiprocessing import Pool
+
+
+def read_ca_coords(filename, seqlen, store=None):
+    """ Reads the C-alpha coordinates and B-factors of the first chain in
+        the first model of a PDB file. Returns None if the chain does not
+        have seqlen residues or a residue lacks its C-alpha atom. Structures
+        that are only contained in the given packed structure store are read
+        from the store.
+    """
+    if store is not None:
+        name = store.packed_name(filename)
+        if name is not None:
+            return store.ca_coords(name, seqlen)
+
+    with open(filename, "r") as f:
+        return parse_ca_coords(f, seqlen)
+
+
+def parse_ca_coords(lines, seqlen):
+    c_alpha = np.zeros((seqlen, 3), dtype=np.float32)
+    b_factors = np.zeros(seqlen, dtype=np.float32)
+
+    chain_id = None
+    residue_id = None
+    residue_count = 0
+    ca_count = 0
+    for line in lines:
+        record = line[:6]
+        if record == "ENDMDL":
+            break
+        if record != "ATOM  " and record != "HETATM":
+            continue
+        if chain_id is None:
+            chain_id = line[21]
+        elif line[21] != chain_id:
+            continue
+
+        current_residue = line[22:27]
+        if current_residue != residue_id:
+            residue_id = current_residue
+            residue_count += 1
+            if residue_count > seqlen:
+                return None
+            has_ca = False
+
+        if line[12:16].strip() == "CA" and not has_ca:
+            has_ca = True
+            c_alpha[residue_count-1] = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+            b_factor = line[60:66].strip()
+            if b_factor:
+                b_factors[residue_count-1] = float(b_factor)
+            ca_count += 1
+
+    if residue_count != seqlen or ca_count != seqlen:
+        return None
+
+    return c_alpha, b_factors
+
+
+def _read_ca_coords_task(task):
+    return read_ca_coords(*task)
+
+
+def read_ca_coords_parallel(filenames, seqlen, jobs=1, chunksize=16, store=None):
+    """ Reads multiple PDB files with read_ca_coords, distributed over a pool
+        of jobs processes. Results are yielded in the order of filenames.
+        Structures contained in the packed structure store are read from its
+        memory map instead.
+    """
+    if store is not None:
+        names = [store.packed_name(filename) for filename in filenames]
+        unpacked = read_ca_coords_parallel([filename for filename, name in zip(filenames, names) if name is None], seqlen, jobs, chunksize)
+        for name in names:
+            if name is None:
+                yield next(unpacked)
+            else:
+                yield store.ca_coords(name, seqlen)
+        return
+
+    if jobs <= 1:
+        for filename in filenames:
+            yield read_ca_coords(filename, seqlen)
+        return
+
+    with Pool(jobs) as pool:
+        for result in pool.imap(_read_ca_coords_task, [(filename, seqlen) for filename in filenames], chunksize):
+            yield result
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from queue import Queue
+from PIL import Image
+from compose_frames import compose_frame
+from progressBar import *
+from render_3d_frames import render_tasks
+from render_mutation_matrices import render_matrix_frame
+
+
+_DONE = object()
+
+
+def _run_stage(func, in_queue, out_queue, errors):
+    """ Applies func to every item of in_queue and passes the results on to
+        out_queue until the end of the stream is reached.
+    """
+    try:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            result = func(item)
+            if out_queue is not None:
+                out_queue.put(result)
+    except BaseException as e:
+        errors.append(e)
+        # keep consuming so that the upstream stage never blocks on a full queue
+        while item is not _DONE:
+            item = in_queue.get()
+    finally:
+        if out_queue is not None:
+            out_queue.put(_DONE)
+
+
+def render_movie_pipeline(tasks, wt_file, movie_width, movie_height, matrix_frame_width, matrix_frames, scale_factor, zoom_factor, encoder, jobs=1, queue_size=8, keep_3d_frames=True, manifest=None, render_batch_size=1):
+    """ Renders, composes and encodes the frames of the given render tasks as
+        overlapping stages connected by bounded queues. Every frame is passed on
+        as soon as its 3D rendering exists, so the number of frames held in
+        memory or on disk does not depend on the length of the protein.
+    """
+    start_time = time.time()
+    total = len(tasks)
+    counter = 0
+    printProgressBar(0, total, prefix='Rendering movie frames:', suffix='Complete', length=50)
+
+    def compose(task):
+        with Image.open(task.png_file) as img_3d:
+            img_mut_matrix = render_matrix_frame(matrix_frames, task.cell[0], task.cell[1])
+            frame = compose_frame(img_3d, img_mut_matrix, movie_width, movie_height, matrix_frame_width)
+        if not keep_3d_frames:
+            os.remove(task.png_file)
+        return frame
+
+    def encode(frame):
+        nonlocal counter
+        encoder.write(frame)
+        counter += 1
+        printProgressBar(counter, total, prefix='Rendering movie frames:', suffix='Complete', length=50)
+
+    errors = []
+    render_queue = Queue(maxsize=queue_size)
+    frame_queue = Queue(maxsize=queue_size)
+    stages = [threading.Thread(target=_run_stage, args=(compose, render_queue, frame_queue, errors), daemon=True),
+              threading.Thread(target=_run_stage, args=(encode, frame_queue, None, errors), daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    try:
+        for task in render_tasks(tasks, wt_file, movie_width - matrix_frame_width, movie_height, scale_factor, zoom_factor, jobs, window=queue_size, manifest=manifest, batch_size=render_batch_size):
+            if len(errors) > 0:
+                break
+            render_queue.put(task)
+    finally:
+        render_queue.put(_DONE)
+        for stage in stages:
+            stage.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    end_time = time.time()
+    print("Elapsed time: {}".format(end_time - start_time))
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+
+def predictor_digest(template_script):
+    """ Digest of the predictor script template. Changing the predictor, its
+        model or parameters in the script starts a new set of cache entries.
+    """
+    with open(template_script, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_file(cache_dir, seq, predictor):
+    """ Location of the structure predicted for a sequence, sharded by the
+        first two characters of its key.
+    """
+    key = hashlib.sha1("{}:{}".format(predictor, seq).encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], "{}.pdb".format(key))
+
+
+def link_file(source, destination):
+    """ Hard-links source to destination, or copies it across file systems.
+        The destination is replaced atomically.
+    """
+    tmp_file = "{}.{}.tmp".format(destination, uuid.uuid4().hex[:8])
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        shutil.copyfile(source, tmp_file)
+    os.replace(tmp_file, destination)
+
+
+class PredictionCache:
+    """ Structures predicted in earlier runs, shared across proteins and
+        prediction directories. Entries are addressed by the sequence and the
+        predictor script, so a mutant of one protein that equals the sequence of
+        another one, or a wild type listed twice, is only predicted once.
+        Entries are hard links of the predicted PDB files where possible.
+    """
+
+    def __init__(self, cache_dir, template_script):
+        self.cache_dir = cache_dir
+        self.predictor = predictor_digest(template_script)
+
+    def file(self, seq):
+        return cache_file(self.cache_dir, seq, self.predictor)
+
+    def link_cached(self, entries, prediction_dir):
+        """ Links the cached structures of (name, sequence) entries into the
+            prediction directory. Returns the entries that still have to be
+            predicted, with one entry per distinct sequence, and the entries
+            with the same sequence as one of those, which are linked after the
+            prediction by link_predicted.
+        """
+        missing = []
+        duplicates = []
+        predicted_names = {}
+        for name, seq in entries:
+            filename = self.file(seq)
+            if os.path.isfile(filename):
+                link_file(filename, os.path.join(prediction_dir, name + ".pdb"))
+            elif seq in predicted_names:
+                duplicates.append((name, seq))
+            else:
+                predicted_names[seq] = name
+                missing.append((name, seq))
+        return missing, duplicates
+
+    def store_predicted(self, entries, prediction_dir):
+        """ Adds the predicted structures of the entries to the cache. Returns
+            the number of new cache entries.
+        """
+        count = 0
+        for name, seq in entries:
+            pdb_file = os.path.join(prediction_dir, name + ".pdb")
+            filename = self.file(seq)
+            if not os.path.isfile(pdb_file) or os.path.isfile(filename):
+                continue
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            link_file(pdb_file, filename)
+            count += 1
+        return count
+
+    def link_predicted(self, entries, prediction_dir):
+        """ Links the cached structures of entries whose sequence was predicted
+            under a different name. Returns the entries without a structure.
+        """
+        failed = []
+        for name, seq in entries:
+            filename = self.file(seq)
+            if os.path.isfile(filename):
+                link_file(filename, os.path.join(prediction_dir, name + ".pdb"))
+            else:
+                failed.append((name, seq))
+        return failed
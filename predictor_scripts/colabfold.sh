@@ -12,6 +12,6 @@ cd MUTAMORE_OUTPUT
 for file in *.pdb; do
   if [[ $file == *rank_001* ]]; then
       new_name="${file%%_unrelaxed*}.pdb"
-      cp "$file" "$new_name"
+      mv "$file" "$new_name"
   fi
 done
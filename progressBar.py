@@ -1,3 +1,12 @@
+import sys
+import time
+
+__all__ = ["printProgressBar"]
+
+# Minimum time between two redraws of a progress bar, larger when the output is not a terminal (e.g. a batch log)
+REDRAW_INTERVAL = 0.1 if sys.stdout.isatty() else 10.0
+_last_redraw = {}
+
 # Print iterations progress
 def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
     """
@@ -12,8 +21,15 @@ def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1,
         fill        - Optional  : bar fill character (Str)
         printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
     """
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filledLength = int(length * iteration // total)
+    # Skip redraws that come too quickly after the previous one, except for the first and the last
+    now = time.monotonic()
+    if 0 < iteration < total and now - _last_redraw.get(prefix, 0.0) < REDRAW_INTERVAL:
+        return
+    _last_redraw[prefix] = now
+    # nothing to do counts as complete
+    fraction = iteration / float(total) if total > 0 else 1.0
+    percent = ("{0:." + str(decimals) + "f}").format(100 * fraction)
+    filledLength = int(length * fraction)
     bar = fill * filledLength + '-' * (length - filledLength)
     print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
     # Print New Line on Complete
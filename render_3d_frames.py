@@ -1,103 +1,418 @@
 import os
 import sys
 import time
-from PIL import Image, ImageFont, ImageDraw, ImageEnhance
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance
+from pdb_reader import read_ca_coords_parallel
 from progressBar import *
-from utils import get_script_path
+from manifest import signature
+from mutants import MutantSet, structure_file
+from structure_similarity import read_wild_type, superposition_transforms, SCORING_BATCH_SIZE
+from structure_store import open_structure_store, structure_signature
+from utils import INTERMEDIATE_PNG_COMPRESSION, load_font
 
-if "pymol" not in  "\t".join(sys.path):
-    sys.path.append("/usr/bin/pymol")
-    sys.path.append("/usr/lib/python")
-    import __main__
-    __main__.pymol_argv = ['pymol','-Qqc']
-    import pymol
-    pymol.finish_launching()
-else: # This IF avoids re-appending to PATH in case you execute this snippet multiple times in the same session
-    import pymol
+pymol = None
+wt_view = None
+loaded_wild_type = None
 
-pymol.cmd.feedback("disable", "all", "actions")
-pymol.cmd.feedback("disable", "all", "results")
+# cheaper PyMOL settings and reduced internal resolution for draft renderings
+DRAFT_SETTINGS = {"antialias": 0, "ray_shadows": 0, "cartoon_sampling": 2, "ray_trace_mode": 0}
+DRAFT_RENDER_SCALE = 0.5
 
+# set by the render server to keep the PyMOL worker processes running between movies
+keep_render_workers = False
+_render_executor = None
 
-def write_png(id, pdb_file, png_file, width=720, height=720, scale_factor=1.0, zoom_factor=None, transparency=False):
-    if os.path.isfile(png_file):
+
+def launch_pymol():
+    """ Starts a headless PyMOL instance for the current process. """
+    global pymol
+    if pymol is not None:
         return
+
+    if "pymol" not in  "\t".join(sys.path):
+        sys.path.append("/usr/bin/pymol")
+        sys.path.append("/usr/lib/python")
+        import __main__
+        __main__.pymol_argv = ['pymol','-Qqc']
+        import pymol
+        pymol.finish_launching()
+    else: # This IF avoids re-appending to PATH in case you execute this snippet multiple times in the same session
+        import pymol
+
+    pymol.cmd.feedback("disable", "all", "actions")
+    pymol.cmd.feedback("disable", "all", "results")
+
+
+def load_structure(id, pdb_file, name, state=0, discrete=0):
+    """ Loads a PDB file into PyMOL, or its entry in the structure store of the protein. """
+    store = open_structure_store(id, os.path.dirname(pdb_file))
+    packed_name = store.packed_name(pdb_file) if store is not None else None
+    if packed_name is not None:
+        pymol.cmd.read_pdbstr(store.pdb_string(packed_name), name, state=state, discrete=discrete)
+    else:
+        pymol.cmd.load(pdb_file, name, state=state, discrete=discrete)
+
+
+def load_wild_type(wt_file, zoom_factor=None):
+    """ Loads the wild type and returns the camera view shared by all frames. """
+    load_structure(os.path.basename(wt_file)[:-4], wt_file, "wt")
+    pymol.cmd.reset()
+    if zoom_factor is not None:
+        pymol.cmd.zoom("center", zoom_factor)
+    return pymol.cmd.get_view()
+
+
+def mutation_label(pdb_file):
+    """ Object name, mutation label and mutated residue number of a structure file. """
     pdb_name = os.path.basename(pdb_file).split('.')[0]
     parts = pdb_name.split("_")
     suffix = parts[-1]
-    from_res = suffix[0]
-    to_res = suffix[-1]
     mid = suffix[1:-1]
     try:
         residx = int(mid)
     except ValueError:
         residx = 0
+    return pdb_name, suffix, residx
 
-    pymol.cmd.load(pdb_file, pdb_name)
-    pymol.cmd.align(pdb_name, "wt")
-    pymol.cmd.reset()
-    pymol.cmd.disable("all")
-    pymol.cmd.enable(pdb_name)
-    pymol.cmd.hide('all')
-    if zoom_factor is not None:
-        pymol.cmd.zoom("center", zoom_factor)
+
+def set_scene_style():
     pymol.cmd.show('cartoon')
     pymol.cmd.set('ray_opaque_background', 1)
     pymol.cmd.set('depth_cue', 0)
     pymol.cmd.bg_color('white')
-    pymol.cmd.spectrum('b', palette='red red red orange yellow cyan blue', minimum=0, maximum=100)
-    pymol.cmd.color('black', 'resi {}'.format(residx))
-    pymol.cmd.png(str(png_file), width=width, height=height, quiet=1)
-    pymol.cmd.delete(pdb_name)
 
+
+def ray_trace_png(png_file, width, height, draft=False):
+    if draft:
+        # ray trace with cheap settings at a lower resolution and scale the image up afterwards
+        saved_settings = {name: pymol.cmd.get(name) for name in DRAFT_SETTINGS}
+        for name, value in DRAFT_SETTINGS.items():
+            pymol.cmd.set(name, value)
+        pymol.cmd.png(str(png_file), width=max(1, int(width * DRAFT_RENDER_SCALE)), height=max(1, int(height * DRAFT_RENDER_SCALE)), quiet=1)
+        for name, value in saved_settings.items():
+            pymol.cmd.set(name, value)
+    else:
+        pymol.cmd.png(str(png_file), width=width, height=height, quiet=1)
+
+
+def annotate_png(png_file, label, width, height, scale_factor=1.0, transparency=False):
+    """ Scales a ray-traced frame to the frame size, fades predicted structures
+        shown next to experimental ones and draws the mutation label.
+    """
     img = Image.open(png_file)
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.BILINEAR)
     if transparency:
         contrast_enhancer = ImageEnhance.Contrast(img)
         img = contrast_enhancer.enhance(0.6)
     draw = ImageDraw.Draw(img)
-    font_file = os.path.join(get_script_path(), "font.ttf")
-    font = ImageFont.truetype(font_file, int(16*scale_factor))
-    draw.text((1, 1), suffix, (0,0,0), font=font)
-    img.save(png_file)
+    font = load_font(int(16*scale_factor))
+    draw.text((1, 1), label, (0,0,0), font=font)
+    img.save(png_file, compress_level=INTERMEDIATE_PNG_COMPRESSION)
+
+
+def write_png(id, pdb_file, png_file, width=720, height=720, scale_factor=1.0, zoom_factor=None, transparency=False, transform=None, view=None, draft=False):
+    if os.path.isfile(png_file):
+        return
+    pdb_name, suffix, residx = mutation_label(pdb_file)
+
+    load_structure(id, pdb_file, pdb_name)
+    if transform is not None:
+        pymol.cmd.transform_object(pdb_name, transform, state=0, homogenous=1)
+    else:
+        pymol.cmd.align(pdb_name, "wt")
+    if view is None:
+        pymol.cmd.reset()
+    pymol.cmd.disable("all")
+    pymol.cmd.enable(pdb_name)
+    pymol.cmd.hide('all')
+    if view is not None:
+        pymol.cmd.set_view(view)
+    elif zoom_factor is not None:
+        pymol.cmd.zoom("center", zoom_factor)
+    set_scene_style()
+    pymol.cmd.spectrum('b', palette='red red red orange yellow cyan blue', minimum=0, maximum=100)
+    pymol.cmd.color('black', 'resi {}'.format(residx))
+    ray_trace_png(png_file, width, height, draft)
+    pymol.cmd.delete(pdb_name)
+
+    annotate_png(png_file, suffix, width, height, scale_factor, transparency)
+
+
+def write_png_states(tasks, width=720, height=720, scale_factor=1.0, view=None):
+    """ Renders the frames of several mutants from a single PyMOL object that
+        holds every mutant as a separate state. The structures are loaded as a
+        discrete object, so that each state keeps its own residues and B-factors,
+        and the representation, coloring and highlighted residues are set up
+        once for all states before the frames are ray-traced state by state.
+        All tasks need the superposition onto the wild type.
+    """
+    tasks = [task for task in tasks if not os.path.isfile(task.png_file)]
+    if len(tasks) == 0:
+        return
+    name = "batch"
+    labels = []
+    for state, task in enumerate(tasks, 1):
+        load_structure(task.id, task.pdb_file, name, state=state, discrete=1)
+        pymol.cmd.transform_object(name, task.transform, state=state, homogenous=1)
+        labels.append(mutation_label(task.pdb_file))
+
+    pymol.cmd.disable("all")
+    pymol.cmd.enable(name)
+    pymol.cmd.hide('all')
+    pymol.cmd.set_view(view)
+    set_scene_style()
+    pymol.cmd.spectrum('b', palette='red red red orange yellow cyan blue', minimum=0, maximum=100, selection=name)
+    for state, (pdb_name, suffix, residx) in enumerate(labels, 1):
+        pymol.cmd.color('black', '{} and state {} and resi {}'.format(name, state, residx))
+
+    for state, (task, (pdb_name, suffix, residx)) in enumerate(zip(tasks, labels), 1):
+        pymol.cmd.frame(state)
+        ray_trace_png(task.png_file, width, height, task.draft)
+        annotate_png(task.png_file, suffix, width, height, scale_factor, task.transparency)
+    pymol.cmd.delete(name)
+    pymol.cmd.frame(1)
     
     
-def render_3d_frames(id, seq, pdb_dir, png_dir, width, height, scale_factor, zoom_factor=None, experimental_mutations=None, experimental_dir=None, topN_indices=None):
+def compute_superpositions(wt_file, pdb_files, seqlen, jobs=1, batch_size=SCORING_BATCH_SIZE, store=None):
+    """ Computes the transformations superposing each structure onto the wild
+        type from C-alpha coordinates, as 16-element row-major matrices. Entries
+        are None for structures that do not have the length of the wild type.
+    """
+    wt_c_alpha = read_wild_type(wt_file, seqlen, store)
+    transforms = [None] * len(pdb_files)
+
+    batch_coords = np.zeros((batch_size, seqlen, 3), dtype=np.float32)
+    batch_indices = []
+
+    def fit_batch():
+        for index, matrix in zip(batch_indices, superposition_transforms(batch_coords[:len(batch_indices)], wt_c_alpha)):
+            transforms[index] = matrix.flatten().tolist()
+        batch_indices.clear()
+
+    for index, result in enumerate(read_ca_coords_parallel(pdb_files, seqlen, jobs, store=store)):
+        if result is None:
+            continue
+        batch_coords[len(batch_indices)] = result[0]
+        batch_indices.append(index)
+        if len(batch_indices) == batch_size:
+            fit_batch()
+    if len(batch_indices) > 0:
+        fit_batch()
+
+    return transforms
+
+
+def use_wild_type(wt_file, zoom_factor=None):
+    """ Makes sure that PyMOL has the given wild type loaded, which is only
+        reloaded if the structure or zoom level changed since the last frame
+        rendered by this process. Returns the camera view of the wild type.
+    """
+    global wt_view, loaded_wild_type
+    id = os.path.basename(wt_file)[:-4]
+    key = (os.path.abspath(wt_file), structure_signature(wt_file, open_structure_store(id, os.path.dirname(wt_file))), zoom_factor)
+    if key != loaded_wild_type:
+        launch_pymol()
+        pymol.cmd.reinitialize()
+        pymol.cmd.feedback("disable", "all", "actions")
+        pymol.cmd.feedback("disable", "all", "results")
+        wt_view = load_wild_type(wt_file, zoom_factor)
+        loaded_wild_type = key
+    return wt_view
+
+
+def _render_task(task, wt_file, width, height, scale_factor, zoom_factor):
+    view = use_wild_type(wt_file, zoom_factor)
+    write_png(task.id, task.pdb_file, task.png_file, width=width, height=height, scale_factor=scale_factor, zoom_factor=zoom_factor, transparency=task.transparency, transform=task.transform, view=view, draft=task.draft)
+
+
+def _render_batch(batch, wt_file, width, height, scale_factor, zoom_factor):
+    """ Renders a chunk of tasks, mutants without a superposition are aligned and rendered one by one. """
+    view = use_wild_type(wt_file, zoom_factor)
+    states = [task for task in batch if task.transform is not None]
+    if len(states) > 1:
+        write_png_states(states, width=width, height=height, scale_factor=scale_factor, view=view)
+    for task in batch:
+        if task.transform is None or len(states) == 1:
+            _render_task(task, wt_file, width, height, scale_factor, zoom_factor)
+
+
+def render_batches(tasks, batch_size):
+    """ Splits the stale tasks into chunks of consecutive frames and returns,
+        for every task, the chunk it is rendered with or None for fresh frames.
+    """
+    stale = [task for task in tasks if task.stale]
+    batches = [stale[k:k + batch_size] for k in range(0, len(stale), batch_size)]
+    batch_of = {}
+    for batch in batches:
+        for task in batch:
+            batch_of[task.png_file] = batch
+    return [batch_of.get(task.png_file) if task.stale else None for task in tasks]
+
+
+@contextmanager
+def render_executor(workers):
+    """ Pool of worker processes with one PyMOL instance each. With
+        keep_render_workers, the pool is kept for later movies, unless a worker
+        died (e.g. PyMOL crashed on a structure), in which case the next movie
+        starts a new pool.
+    """
+    global _render_executor
+    if not keep_render_workers:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), initializer=launch_pymol) as executor:
+            yield executor
+        return
+
+    # _broken is set by the executor once a worker has died, e.g. after an error that was handled elsewhere
+    if _render_executor is not None and (_render_executor[0] != workers or getattr(_render_executor[1], "_broken", False)):
+        _render_executor[1].shutdown(wait=False)
+        _render_executor = None
+    if _render_executor is None:
+        _render_executor = (workers, ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), initializer=launch_pymol))
+    try:
+        yield _render_executor[1]
+    except BrokenProcessPool:
+        _render_executor[1].shutdown(wait=False)
+        _render_executor = None
+        raise
+
+
+RenderTask = namedtuple("RenderTask", ["id", "cell", "pdb_file", "png_file", "transparency", "transform", "key", "stale", "draft"])
+
+
+def prepare_render_tasks(id, seq, pdb_dir, png_dir, width, height, scale_factor, zoom_factor=None, experimental_mutations=None, experimental_dir=None, topN_indices=None, jobs=1, mutants=None, manifest=None, draft=False):
+    """ Lists the 3D frames of all selected mutants in movie order. Frames
+        that still have to be rendered get their superposition onto the wild
+        type. With a build manifest, frames rendered from other structures or
+        parameters are stale, otherwise only frames that do not exist yet.
+    """
+    store = open_structure_store(id, pdb_dir)
+    wt_file = os.path.join(pdb_dir, "{}.pdb".format(id))
+    wt_signature = structure_signature(wt_file, store) if manifest is not None else None
+    if mutants is None:
+        mutants = MutantSet(seq)
+
+    tasks = []
+    for mutant in mutants.selected(topN_indices):
+        transparency = False
+        if experimental_mutations is not None and not mutant.name in experimental_mutations:
+            transparency = True
+
+        pdb_file = structure_file(id, mutant, pdb_dir, experimental_mutations, experimental_dir)
+        png_file = os.path.join(png_dir, "{}_{}.png".format(id, mutant.name))
+
+        if manifest is not None:
+            key = signature(structure_signature(pdb_file, store), wt_signature, width, height, scale_factor, zoom_factor, transparency, draft)
+            stale = not manifest.is_current("3d", png_file, key)
+        else:
+            key = None
+            stale = not os.path.isfile(png_file)
+        tasks.append(RenderTask(id, mutant.cell, pdb_file, png_file, transparency, None, key, stale, draft))
+
+    # superpose all mutants onto the wild type up front instead of aligning them in PyMOL,
+    # frames that are up to date are skipped
+    missing = [k for k, task in enumerate(tasks) if task.stale]
+    transforms = compute_superpositions(wt_file, [tasks[k].pdb_file for k in missing], len(seq), jobs, store=store)
+    for k, transform in zip(missing, transforms):
+        tasks[k] = tasks[k]._replace(transform=transform)
+
+    return tasks
+
+
+def render_tasks(tasks, wt_file, width, height, scale_factor, zoom_factor=None, jobs=1, window=None, manifest=None, batch_size=1):
+    """ Renders the 3D frames of the stale tasks and yields every task once
+        its frame is up to date, in the order of tasks. With jobs > 1, at most
+        window frames are rendered ahead of the consumer. With batch_size > 1,
+        chunks of consecutive frames are rendered from one multi-state object.
+    """
+    if window is None:
+        window = 4 * jobs
+    window = max(window, jobs * batch_size)
+    pending = [task for task in tasks if task.stale]
+    for task in pending:
+        if os.path.isfile(task.png_file):
+            os.remove(task.png_file)
+
+    rendered = 0
+    try:
+        for task in _render_tasks(tasks, pending, wt_file, width, height, scale_factor, zoom_factor, jobs, window, batch_size):
+            if manifest is not None and task.stale:
+                manifest.record("3d", task.png_file, task.key)
+                rendered += 1
+                # persist progress regularly in case the run is interrupted
+                if rendered % 100 == 0:
+                    manifest.save()
+            yield task
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
+def _render_tasks(tasks, pending, wt_file, width, height, scale_factor, zoom_factor, jobs, window, batch_size=1):
+    global loaded_wild_type
+    batches = render_batches(tasks, batch_size)
+
+    if jobs > 1 and len(pending) > batch_size:
+        # every worker process runs its own PyMOL instance and loads the wild type with its first frame
+        workers = jobs if keep_render_workers else min(jobs, (len(pending) + batch_size - 1) // batch_size)
+        with render_executor(workers) as executor:
+            futures = deque()
+            future = None
+            for task, batch in zip(tasks, batches):
+                if batch is None:
+                    future = None
+                elif batch[0] is task:
+                    # the chunk is submitted with its first frame, the other frames wait for the same future
+                    if batch_size == 1:
+                        future = executor.submit(_render_task, task, wt_file, width, height, scale_factor, zoom_factor)
+                    else:
+                        future = executor.submit(_render_batch, batch, wt_file, width, height, scale_factor, zoom_factor)
+                futures.append((task, future))
+
+                # hand out finished frames in order, keeping at most window frames in flight
+                while len(futures) > window or (len(futures) > 0 and (futures[0][1] is None or futures[0][1].done())):
+                    task, future = futures.popleft()
+                    if future is not None:
+                        future.result()
+                    yield task
+            while len(futures) > 0:
+                task, future = futures.popleft()
+                if future is not None:
+                    future.result()
+                yield task
+    else:
+        for task, batch in zip(tasks, batches):
+            if batch is not None and batch[0] is task:
+                if batch_size == 1:
+                    _render_task(task, wt_file, width, height, scale_factor, zoom_factor)
+                else:
+                    _render_batch(batch, wt_file, width, height, scale_factor, zoom_factor)
+            yield task
+        if len(pending) > 0 and not keep_render_workers:
+            pymol.cmd.reinitialize()
+            loaded_wild_type = None
+
+
+def render_3d_frames(id, seq, pdb_dir, png_dir, width, height, scale_factor, zoom_factor=None, experimental_mutations=None, experimental_dir=None, topN_indices=None, jobs=1, manifest=None, mutants=None, draft=False, batch_size=1):
     start_time = time.time()
 
+    if mutants is None:
+        mutants = MutantSet(seq)
     wt_file = os.path.join(pdb_dir, "{}.pdb".format(id))
-    pymol.cmd.load(wt_file, "wt")
-
-    total = len(seq) * 19
-    printProgressBar(0, total, prefix = 'Rendering 3D structures:', suffix = 'Complete', length = 50)
-    counter = 0
-    aa_list = list("ACDEFGHIKLMNPQRSTVWY")
-    for i in range(len(seq)):
-        for aa in list("ACDEFGHIKLMNPQRSTVWY"):
-            if aa == seq[i]:
-                continue
-            if topN_indices is not None and topN_indices[aa_list.index(aa), i] == False:
-                counter += 1
-                printProgressBar(counter, total, prefix = 'Rendering 3D structures:', suffix = 'Complete', length = 50)
-                continue
-            temp_seq = seq.copy()
-            temp_seq[i] = aa
-            
-            mut_name = seq[i] + str(i+1) + aa
-            transparency = False
-            if experimental_mutations is not None and not mut_name in experimental_mutations:
-                transparency = True
-            
-            if experimental_mutations is not None and mut_name in experimental_mutations:
-                pdb_file = os.path.join(experimental_dir, mut_name + ".pdb")
-            else:
-                pdb_file = os.path.join(pdb_dir, "{}_{}{}{}.pdb".format(id, seq[i], i+1, aa))
-            png_file = os.path.join(png_dir, "{}_{}{}{}.png".format(id, seq[i], i+1, aa))
-            write_png(id, pdb_file, png_file, width=width, height=height, scale_factor=scale_factor, zoom_factor=zoom_factor, transparency=transparency)
-            
-            counter += 1
-            printProgressBar(counter, total, prefix = 'Rendering 3D structures:', suffix = 'Complete', length = 50)
-            
-    pymol.cmd.reinitialize()
-            
+    tasks = prepare_render_tasks(id, seq, pdb_dir, png_dir, width, height, scale_factor, zoom_factor, experimental_mutations, experimental_dir, topN_indices, jobs, mutants=mutants, manifest=manifest, draft=draft)
+
+    total = len(mutants)
+    counter = total - len(tasks)
+    printProgressBar(counter, total, prefix = 'Rendering 3D structures:', suffix = 'Complete', length = 50)
+    for task in render_tasks(tasks, wt_file, width, height, scale_factor, zoom_factor, jobs, window=len(tasks), manifest=manifest, batch_size=batch_size):
+        counter += 1
+        printProgressBar(counter, total, prefix = 'Rendering 3D structures:', suffix = 'Complete', length = 50)
+
     end_time = time.time()
     print("Elapsed time: {}".format(end_time - start_time))
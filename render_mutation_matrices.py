@@ -1,86 +1,14 @@
-from Bio.PDB import *
 import numpy as np
 import os
 import time
-from scipy.spatial.distance import cdist
-from PIL import Image, ImageFont, ImageDraw
+from collections import namedtuple
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from manifest import signature
+from mutants import AMINO_ACIDS, MutantSet
 from progressBar import *
-from utils import get_script_path
-
-
-def distance_map_from_pdb(parser, filename, seqlen):
-    structure = parser.get_structure(filename, filename)
-
-    c_alpha = np.zeros((seqlen, 3))
-    for chain in structure[0]:
-        if len(chain) != seqlen:
-            return None
-        for i,residue in enumerate(chain):
-            c_alpha[i] = residue["CA"].get_coord()
-        break
-
-    return cdist(c_alpha, c_alpha)
-
-
-def distance_diff(d1, d2):
-    length = d1.shape[-1]
-    cutoff = 15.0
-    mask_2d = (d1 < cutoff) * (1.0 - np.eye(length))
-
-    dist_l1 = np.absolute(d1 - d2)
-
-    lddt_score = (dist_l1 < 0.5).astype(dist_l1.dtype) + \
-                 (dist_l1 < 1.0).astype(dist_l1.dtype) + \
-                 (dist_l1 < 2.0).astype(dist_l1.dtype) + \
-                 (dist_l1 < 4.0).astype(dist_l1.dtype)
-    lddt_score *= 0.25
-    lddt_score *= mask_2d
-
-    lddt_score = (1e-10 + np.sum(lddt_score, axis=(-1,))) / \
-                 (1e-10 + np.sum(mask_2d, axis=(-1,)))
-    return np.average(lddt_score)
-
-
-def get_mutation_matrix(id, seq, pdb_dir, experimental_mutations, experimental_dir):
-    parser = PDBParser(QUIET=True)
-    wt_file = os.path.join(pdb_dir, "{}.pdb".format(id))
-    ref_distance_map = distance_map_from_pdb(parser, wt_file, len(seq))
-    
-    start_time = time.time()
-    aa_list = list("ACDEFGHIKLMNPQRSTVWY")
-    total = len(seq) * 19
-    counter = 0
-    printProgressBar(0, total, prefix = 'Calculating structural similarity:', suffix = 'Complete', length = 50)
-    mut_matrix = np.ones((20, len(seq)))
-    for i in range(len(seq)):
-        for aa in aa_list:
-            if aa == seq[i]:
-                continue
-            temp_seq = seq.copy()
-            temp_seq[i] = aa    
-            mut_name = seq[i] + str(i+1) + aa
-
-            if experimental_mutations is not None and mut_name in experimental_mutations:
-                filename = os.path.join(experimental_dir, mut_name + ".pdb")
-            else:
-                filename = os.path.join(pdb_dir, "{}_{}{}{}.pdb".format(id, seq[i], i+1, aa))
-            dist_map = distance_map_from_pdb(parser, filename, len(seq))
-            
-            if dist_map is None:
-                print("WARNING: ignoring experimental structure {} since it does not have the same length as the wild-type structure".format(filename))
-                mut_matrix[aa_list.index(aa), i] = 0.0
-                continue
-
-            delta = distance_diff(ref_distance_map, dist_map)
-            mut_matrix[aa_list.index(aa), i] = delta
-            
-            counter += 1
-            printProgressBar(counter, total, prefix = 'Calculating structural similarity:', suffix = 'Complete', length = 50)
-            
-    end_time = time.time()
-    print("Elapsed time: {}".format(end_time - start_time))
-            
-    return mut_matrix
+from structure_similarity import get_mutation_matrix
+from utils import INTERMEDIATE_PNG_COMPRESSION, load_font
 
 
 def gradient_color(minval, maxval, val, color_palette=((0,0,0), (255,0,0), (255, 165, 0), (255,255,255))):
@@ -98,103 +26,241 @@ def gradient_color(minval, maxval, val, color_palette=((0,0,0), (255,0,0), (255,
     return int(r1 + f*(r2-r1)), int(g1 + f*(g2-g1)), int(b1 + f*(b2-b1))
     
     
-def render_matrix_frames(id, seq, mut_matrix, legend, aa_labels, height, out_dir, width, margin_horiz, margin_vert, scale_factor, topN_indices):
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
+def gradient_colors(minval, maxval, values, color_palette=((0,0,0), (255,0,0), (255, 165, 0), (255,255,255))):
+    """ Vectorized gradient_color for an array of values, returns an array of
+        8-bit RGB colors with one additional trailing dimension.
+    """
+    palette = np.array(color_palette, dtype=np.float64)
+    max_index = len(palette)-1
+    delta = maxval - minval
+    if delta == 0:
+        delta = 1
+    v = (np.asarray(values, dtype=np.float64) - minval) / delta * max_index
+    i1 = np.trunc(v).astype(int)
+    i2 = np.minimum(i1+1, max_index)
+    f = (v - i1)[..., np.newaxis]
+    # same palette indexing and clamping as drawing the colors of gradient_color
+    c1, c2 = np.take(palette, i1, axis=0, mode='wrap'), np.take(palette, i2, axis=0, mode='wrap')
+    return np.clip(np.trunc(c1 + f*(c2-c1)), 0, 255).astype(np.uint8)
 
-    start_time = time.time()
 
+MatrixFrames = namedtuple("MatrixFrames", ["base", "colors", "margin_horiz", "offset_y", "cell_width", "cell_height", "key", "rows", "inset"])
+MatrixInset = namedtuple("MatrixInset", ["x", "y", "cell_width", "cell_height", "window", "font_size"])
+
+
+def pool_rows(mut_matrix, rows):
+    """ Pools the residues of the mutation matrix into the given number of
+        rows, keeping the minimum similarity of every bucket so that strongly
+        affected mutants remain visible. Returns the pooled matrix and the row
+        of every residue.
+    """
+    length = mut_matrix.shape[1]
+    row_of = np.arange(length) * rows // length
+    starts = np.searchsorted(row_of, np.arange(rows))
+    return np.minimum.reduceat(mut_matrix, starts, axis=1), row_of
+
+
+def tick_interval(length, rows, font_size):
+    """ Smallest round number of residues between two position labels that do
+        not overlap in a pooled matrix.
+    """
+    for interval in (10, 50, 100, 250, 500, 1000, 2500, 5000):
+        if interval * rows / length > font_size + 2:
+            return interval
+    return 10000
+
+
+def render_matrix_base(seq, mut_matrix, legend, aa_labels, height, width, margin_horiz, margin_vert, scale_factor):
+    """ Draws the complete mutation matrix panel without any highlighted cell.
+        Proteins with more residues than pixel rows are shown with pooled rows
+        and a zoomed inset around the current position in every frame.
+    """
     length = len(seq)
 
     ticks = 10
     if length > 400:
         ticks = 50
-    
+
     font_size = int(12 * scale_factor)
-    font_file = os.path.join(get_script_path(), "font.ttf")
-    font = ImageFont.truetype(font_file, font_size)
-    
+    font = load_font(font_size)
+
     cell_width = int(5 * scale_factor)
     cell_height = int((height - margin_vert*2) / length)
-    
+
+    row_matrix = mut_matrix
+    rows = np.arange(length)
+    if cell_height == 0:
+        cell_height = 1
+        row_matrix, rows = pool_rows(mut_matrix, height - margin_vert*2)
+        ticks = tick_interval(length, row_matrix.shape[1], font_size)
+    row_count = row_matrix.shape[1]
+
     # calculate offset to center the mutation matrix vertically
-    matrix_height = length*cell_height + 1
+    matrix_height = row_count*cell_height + 1
     offset_y = int(height / 2 - matrix_height / 2)
-    
-    if cell_height == 0:
-        print("ERROR: Can not render mutation matrix. Your protein is too long for the requested movie resolution.")
-        print("Try setting a higher (vertical) resolution.")
-        quit()
 
-    aa_list = list("ACDEFGHIKLMNPQRSTVWY")
-    total = len(seq) * 19
+    im = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+    draw = ImageDraw.Draw(im)
+
+    # matrix cells, one row of cells per residue (or bucket of residues)
+    colors = gradient_colors(0.3, 1.0, mut_matrix)
+    row_colors = colors if row_matrix is mut_matrix else gradient_colors(0.3, 1.0, row_matrix)
+    cells = np.repeat(np.repeat(row_colors.transpose(1, 0, 2), cell_height, axis=0), cell_width, axis=1)
+    im.paste(Image.fromarray(cells, 'RGB'), (margin_horiz, offset_y))
+
+    for idx in range(length):
+        if idx+1 == 1 or (idx+1) % ticks == 0:
+            x0 = margin_horiz + 20*cell_width + 1
+            y0 = offset_y + rows[idx] * cell_height - font_size/2 - 1
+            draw.text((x0, y0), "-{}".format(idx+1), (0,0,0), font=font)
+
+    # outline for the whole mutation matrix
+    x0 = margin_horiz - 1
+    y0 = offset_y - 1
+    x1 = x0 + 20*cell_width + 1
+    y1 = y0 + row_count*cell_height + 1
+    draw.rectangle((x0,y0,x1,y1), outline=(0,0,0))
+
+    # amino acid labels
+    im.paste(aa_labels, (margin_horiz, offset_y - int(11*scale_factor)))
+
+    # left boundary line
+    draw.line([(0,0), (0,height)], fill=(100,100,100))
+
+    # draw legend
+    legend_x_offset = int(60 * scale_factor)
+    legend_y_offset = int(30 * scale_factor)
+    im.paste(legend, (width - margin_horiz - legend_x_offset, int(height / 2) - legend_y_offset))
+
+    # rows of a single pixel are too thin to show the highlighted cell, so a
+    # zoomed inset is placed above the legend
+    inset = None
+    if cell_height == 1:
+        inset_cell_width = max(1, int(2.5 * scale_factor))
+        inset_cell_height = max(2, int(5 * scale_factor))
+        inset_font_size = int(8 * scale_factor)
+        inset_x = width - margin_horiz - 20*inset_cell_width
+        inset_y = offset_y + inset_font_size + int(4 * scale_factor)
+        window = min(length, (int(height / 2) - legend_y_offset - inset_y - int(5 * scale_factor)) // inset_cell_height)
+        if window > 0:
+            inset = MatrixInset(inset_x, inset_y, inset_cell_width, inset_cell_height, window, inset_font_size)
+
+    key = signature(mut_matrix.tobytes(), height, width, margin_horiz, margin_vert, scale_factor)
+    return MatrixFrames(im, colors, margin_horiz, offset_y, cell_width, cell_height, key, rows, inset)
+
+
+def draw_inset(im, matrix_frames, m, idx):
+    """ Draws the mutation matrix around position idx at full resolution, with
+        the cell of amino acid m highlighted, and marks the shown residues in
+        the pooled matrix.
+    """
+    inset = matrix_frames.inset
+    length = matrix_frames.colors.shape[1]
+    start = min(max(idx - inset.window // 2, 0), length - inset.window)
+    end = start + inset.window
+
+    cells = matrix_frames.colors[:, start:end].transpose(1, 0, 2)
+    cells = np.repeat(np.repeat(cells, inset.cell_height, axis=0), inset.cell_width, axis=1)
+    im.paste(Image.fromarray(np.ascontiguousarray(cells), 'RGB'), (inset.x, inset.y))
+
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((inset.x - 1, inset.y - 1, inset.x + 20*inset.cell_width, inset.y + inset.window*inset.cell_height), outline=(0,0,0))
+    draw.text((inset.x, inset.y - inset.font_size - 2), "{}-{}".format(start+1, end), (0,0,0), font=load_font(inset.font_size))
+
+    x0 = inset.x + m * inset.cell_width
+    y0 = inset.y + (idx - start) * inset.cell_height
+    color = tuple(int(c) for c in matrix_frames.colors[m, idx])
+    draw.rectangle((x0, y0, x0 + inset.cell_width - 1, y0 + inset.cell_height - 1), fill=color, outline=(0,0,0))
+
+    # bracket left of the matrix spanning the residues shown in the inset
+    x = matrix_frames.margin_horiz - 3
+    y0 = matrix_frames.offset_y + matrix_frames.rows[start] * matrix_frames.cell_height
+    y1 = matrix_frames.offset_y + (matrix_frames.rows[end - 1] + 1) * matrix_frames.cell_height - 1
+    draw.line([(x, y0), (x, y1)], fill=(0,0,0))
+
+
+def render_matrix_frame(matrix_frames, m, idx):
+    """ Returns a copy of the mutation matrix panel with the cell of amino
+        acid m at sequence position idx outlined.
+    """
+    im = matrix_frames.base.copy()
+    draw = ImageDraw.Draw(im)
+    x0 = matrix_frames.margin_horiz + m * matrix_frames.cell_width
+    y0 = matrix_frames.offset_y + matrix_frames.rows[idx] * matrix_frames.cell_height
+    x1 = x0 + matrix_frames.cell_width - 1
+    y1 = y0 + matrix_frames.cell_height - 1
+    color = tuple(int(c) for c in matrix_frames.colors[m, idx])
+    if matrix_frames.inset is not None:
+        # widen the outline of single-pixel rows so that the highlighted row stays visible
+        y0 -= 1
+        y1 += 1
+    draw.rectangle((x0,y0,x1,y1), fill=color, outline=(0,0,0))
+    if matrix_frames.inset is not None:
+        draw_inset(im, matrix_frames, m, idx)
+    return im
+
+
+def matrix_palette(matrix_frames, m, idx):
+    """ Palette of 256 colors for all frames of a protein, taken from one of
+        its frames, so that colors do not change between frames.
+    """
+    return render_matrix_frame(matrix_frames, m, idx).convert("RGB").quantize(256, method=Image.FASTOCTREE)
+
+
+def render_matrix_frames(id, seq, matrix_frames, out_dir, topN_indices, manifest=None, mutants=None, palettize=False):
+    """ Writes the mutation matrix frames of the selected mutants. With
+        palettize, frames are stored as palette images with the colors mapped
+        to the nearest color of a palette shared by all frames, which makes
+        them several times smaller.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    start_time = time.time()
+
+    if mutants is None:
+        mutants = MutantSet(seq)
+    total = len(mutants)
     counter = 0
+    palette = None
+    if palettize and total > 0:
+        palette = matrix_palette(matrix_frames, *mutants.mutants[0].cell)
     printProgressBar(0, total, prefix = 'Rendering mutation matrices:', suffix = 'Complete', length = 50)
-    for i in range(len(seq)):
-        for aa in aa_list:
-            if aa == seq[i]:
-                continue
-            if topN_indices is not None and topN_indices[aa_list.index(aa), i] == False:
+    for mutant in mutants:
+        if topN_indices is not None and topN_indices[mutant.cell] == False:
+            counter += 1
+            printProgressBar(counter, total, prefix = 'Rendering mutation matrices:', suffix = 'Complete', length = 50)
+            continue
+
+        filename = os.path.join(out_dir, "{}_matrix_{}.png".format(id, mutant.name))
+        if manifest is not None:
+            key = signature(matrix_frames.key, *mutant.cell) if palette is None else signature(matrix_frames.key, *mutant.cell, "palette")
+            if manifest.is_current("matrix", filename, key):
                 counter += 1
                 printProgressBar(counter, total, prefix = 'Rendering mutation matrices:', suffix = 'Complete', length = 50)
                 continue
-            temp_seq = seq.copy()
-            temp_seq[i] = aa    
-            
-            im = Image.new('RGBA', (width, height), (255, 255, 255, 255))
-            draw = ImageDraw.Draw(im)
-            
-            for idx in range(length):
-                if idx+1 == 1 or (idx+1) % ticks == 0:
-                    x0 = margin_horiz + 20*cell_width + 1
-                    y0 = offset_y + idx * cell_height - font_size/2 - 1
-                    draw.text((x0, y0), "-{}".format(idx+1), (0,0,0), font=font)
-        
-                for m in range(20):
-                    x0 = margin_horiz + m * cell_width
-                    y0 = offset_y + idx * cell_height
-                    x1 = x0 + cell_width
-                    y1 = y0 + cell_height
-                    color = gradient_color(0.3, 1.0, mut_matrix[m][idx])
-                    outline = None
-                    if idx == i and m == aa_list.index(aa):
-                        outline = (0,0,0)
-                        x1 -= 1
-                        y1 -= 1
-                    draw.rectangle((x0,y0,x1,y1), fill=color, outline=outline)
-            
-            # outline for the whole mutation matrix
-            x0 = margin_horiz - 1
-            y0 = offset_y - 1
-            x1 = x0 + 20*cell_width + 1
-            y1 = y0 + length*cell_height + 1
-            draw.rectangle((x0,y0,x1,y1), outline=(0,0,0))
-            
-            # amino acid labels
-            im.paste(aa_labels, (margin_horiz, offset_y - int(11*scale_factor)))
-    
-            # left boundary line
-            draw.line([(0,0), (0,height)], fill=(100,100,100))
-    
-            # draw legend
-            legend_x_offset = int(60 * scale_factor)
-            legend_y_offset = int(30 * scale_factor)
-            im.paste(legend, (width - margin_horiz - legend_x_offset, int(height / 2) - legend_y_offset))
-            
-            filename = os.path.join(out_dir, "{}_matrix_{}{}{}.png".format(id, seq[i], i+1, aa))
-            im.save(filename)
-            counter += 1
-            printProgressBar(counter, total, prefix = 'Rendering mutation matrices:', suffix = 'Complete', length = 50)
-            
+
+        im = render_matrix_frame(matrix_frames, *mutant.cell)
+        if palette is not None:
+            im = im.convert("RGB").quantize(palette=palette, dither=Image.NONE)
+        im.save(filename, compress_level=INTERMEDIATE_PNG_COMPRESSION)
+        if manifest is not None:
+            manifest.record("matrix", filename, key)
+        counter += 1
+        printProgressBar(counter, total, prefix = 'Rendering mutation matrices:', suffix = 'Complete', length = 50)
+
+    if manifest is not None:
+        manifest.save()
+
     end_time = time.time()
     print("Elapsed time: {}".format(end_time - start_time))
-    
-    
+
+
+@lru_cache(maxsize=None)
 def draw_legend(scale_factor):
     font_size = int(12 * scale_factor)
 
-    font_file = os.path.join(get_script_path(), "font.ttf")
-    font = ImageFont.truetype(font_file, font_size)
+    font = load_font(font_size)
 
     size_x = int(60 * scale_factor)
     size_y = int(110 * scale_factor)
@@ -239,37 +305,47 @@ def draw_legend(scale_factor):
     return im
     
 
+@lru_cache(maxsize=None)
 def draw_amino_acid_labels(scale_factor):
     font_size = int(7 * scale_factor)
-    font_file = os.path.join(get_script_path(), "font.ttf")
-    font = ImageFont.truetype(font_file, font_size)
+    font = load_font(font_size)
     
     size_x = int(100 * scale_factor)
     size_y = int(10 * scale_factor)
     im = Image.new('RGBA', (size_x, size_y), (255, 255, 255, 255))
     draw = ImageDraw.Draw(im)
-    for i,c in enumerate("ACDEFGHIKLMNPQRSTVWY"):
+    for i,c in enumerate(AMINO_ACIDS):
         pos = int(i * 5 * scale_factor)
         draw.text((pos,0), c, (0,0,0), font=font)
     
     return im
     
 
-def render_mutation_matrices(id, seq, height, pdb_dir, out_dir, width=250, margin_horiz=25, margin_vert=20, scale_factor=1.0, experimental_mutations=None, experimental_dir=None, topN=None):
+def render_mutation_matrices(id, seq, height, pdb_dir, out_dir, width=250, margin_horiz=25, margin_vert=20, scale_factor=1.0, experimental_mutations=None, experimental_dir=None, topN=None, jobs=1, manifest=None, mutants=None, palettize=False):
+    if mutants is None:
+        mutants = MutantSet(seq)
+
     # draw legend
     legend = draw_legend(scale_factor)
     
     # draw amino acid labels
     aa_labels = draw_amino_acid_labels(scale_factor)
 
-    mut_matrix = get_mutation_matrix(id, seq, pdb_dir, experimental_mutations, experimental_dir)
+    mut_matrix = get_mutation_matrix(id, seq, pdb_dir, experimental_mutations, experimental_dir, jobs=jobs, mutants=mutants)
     
     # if topN is set, get positions with highest structural difference
     topN_indices = None
     if topN is not None:
-        topN_similarity = bottom_k = np.partition(mut_matrix.flatten(), topN)[:topN]
-        threshold = np.sort(topN_similarity)[-1]
-        topN_indices = mut_matrix <= threshold
+        similarity = np.array([mut_matrix[mutant.cell] for mutant in mutants])
+        if topN < len(similarity):
+            threshold = np.partition(similarity, topN - 1)[topN - 1]
+            topN_indices = mut_matrix <= threshold
+        else:
+            topN_indices = np.ones(mut_matrix.shape, dtype=bool)
     
-    render_matrix_frames(id, seq, mut_matrix, legend, aa_labels, height, out_dir, width=width, margin_horiz=margin_horiz, margin_vert=margin_vert, scale_factor=scale_factor, topN_indices=topN_indices)
-    return topN_indices
+    matrix_frames = render_matrix_base(seq, mut_matrix, legend, aa_labels, height, width, margin_horiz, margin_vert, scale_factor)
+
+    # without an output directory, frames are rendered on demand from the returned base image
+    if out_dir is not None:
+        render_matrix_frames(id, seq, matrix_frames, out_dir, topN_indices, manifest, mutants, palettize)
+    return topN_indices, matrix_frames
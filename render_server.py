@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+import uuid
+from contextlib import redirect_stderr, redirect_stdout
+
+
+def spool_dirs(spool_dir):
+    """ Job files move from queue/ to running/ to done/, where the result and
+        the output of every job are kept.
+    """
+    dirs = {name: os.path.join(spool_dir, name) for name in ("queue", "running", "done")}
+    for directory in dirs.values():
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    return dirs
+
+
+def write_json(filename, data):
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, filename)
+
+
+def submit_job(spool_dir, arguments, cwd):
+    """ Queues a MutAmore run with the given command line arguments, which are
+        interpreted relative to cwd. Returns the job identifier.
+    """
+    dirs = spool_dirs(spool_dir)
+    job_id = "{}_{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+    write_json(os.path.join(dirs["queue"], job_id + ".json"), {"id": job_id, "arguments": arguments, "cwd": cwd, "submitted": time.time()})
+    return job_id
+
+
+def wait_for_job(spool_dir, job_id, poll_interval=0.5, output=sys.stdout):
+    """ Waits for a job to finish while passing on its output. Returns the result. """
+    dirs = spool_dirs(spool_dir)
+    result_file = os.path.join(dirs["done"], job_id + ".json")
+    log_files = [os.path.join(dirs["running"], job_id + ".log"), os.path.join(dirs["done"], job_id + ".log")]
+    offset = 0
+    while True:
+        # check for the result first, the log is complete once the result exists
+        finished = os.path.isfile(result_file)
+        for log_file in log_files:
+            try:
+                with open(log_file, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            offset += len(data)
+            output.write(data.decode(errors="replace"))
+            output.flush()
+            break
+        if finished:
+            with open(result_file, "r") as f:
+                return json.load(f)
+        time.sleep(poll_interval)
+
+
+def claim_next_job(dirs):
+    """ Moves the oldest queued job to running/. Renaming is atomic, so several
+        servers can share one spool directory.
+    """
+    for file_name in sorted(os.listdir(dirs["queue"])):
+        if not file_name.endswith(".json"):
+            continue
+        job_file = os.path.join(dirs["running"], file_name)
+        try:
+            os.rename(os.path.join(dirs["queue"], file_name), job_file)
+        except FileNotFoundError:
+            continue
+        return job_file
+    return None
+
+
+def run_job(job_file, dirs):
+    from run_movie_rendering import PATH_ARGUMENTS, parse_args, run
+
+    with open(job_file, "r") as f:
+        job = json.load(f)
+    job_id = job["id"]
+    log_file = os.path.join(dirs["running"], job_id + ".log")
+
+    print("Running job {}: {}".format(job_id, " ".join(job["arguments"])))
+    start_time = time.time()
+    status = "failed"
+    server_cwd = os.getcwd()
+    with open(log_file, "w", buffering=1) as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            os.chdir(job["cwd"])
+            # the PyMOL workers kept between jobs stay in the directory of the first job,
+            # so paths are passed on as absolute paths
+            args = parse_args(job["arguments"])
+            for name in PATH_ARGUMENTS:
+                if getattr(args, name) is not None:
+                    setattr(args, name, os.path.abspath(os.path.join(job["cwd"], getattr(args, name))))
+            run(args)
+            status = "ok"
+        except SystemExit as e:
+            # quit() after an error message, or argparse
+            status = "ok" if e.code == 0 else "failed"
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os.chdir(server_cwd)
+    end_time = time.time()
+
+    os.replace(log_file, os.path.join(dirs["done"], job_id + ".log"))
+    write_json(os.path.join(dirs["done"], job_id + ".json"), {"id": job_id, "status": status, "seconds": end_time - start_time, "finished": end_time})
+    os.remove(job_file)
+    print("Finished job {} ({}), elapsed time: {}".format(job_id, status, end_time - start_time))
+
+
+def warm_up():
+    """ Imports the rendering modules and starts PyMOL once for all jobs. """
+    import run_movie_rendering
+    import render_3d_frames
+
+    render_3d_frames.keep_render_workers = True
+    try:
+        render_3d_frames.launch_pymol()
+    except ImportError:
+        print("WARNING: PyMOL could not be started, jobs that render 3D frames will fail")
+
+
+def serve(spool_dir, poll_interval=1.0):
+    dirs = spool_dirs(spool_dir)
+    warm_up()
+    print("Waiting for jobs in {}".format(os.path.abspath(dirs["queue"])))
+    while True:
+        job_file = claim_next_job(dirs)
+        if job_file is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(job_file, dirs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='render_server',
+                    description='Long-running MutAmore worker that keeps PyMOL and the rendering assets loaded between jobs')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Process jobs from the spool directory back to back")
+    serve_parser.add_argument('--spool', type=str, help="Spool directory for jobs (default: ./spool)", default="./spool")
+    serve_parser.add_argument('--poll_interval', type=float, help="Seconds between checks for new jobs (default: 1)", default=1.0)
+
+    submit_parser = subparsers.add_parser("submit", help="Submit a job with the arguments of run_movie_rendering.py and wait for it")
+    submit_parser.add_argument('--spool', type=str, help="Spool directory for jobs (default: ./spool)", default="./spool")
+    submit_parser.add_argument('--no-wait', dest="wait", action="store_false", help="Return right after submitting the job")
+    submit_parser.add_argument('arguments', nargs=argparse.REMAINDER, help="Arguments of run_movie_rendering.py, after --")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.spool, args.poll_interval)
+    elif args.command == "submit":
+        arguments = args.arguments
+        if len(arguments) > 0 and arguments[0] == "--":
+            arguments = arguments[1:]
+        job_id = submit_job(args.spool, arguments, os.getcwd())
+        print("Submitted job {}".format(job_id))
+        if not args.wait:
+            return
+        result = wait_for_job(args.spool, job_id)
+        if result["status"] != "ok":
+            print("Job {} failed".format(job_id))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,40 @@ import argparse
 import os
 import time
 import shutil
-import stat
+from collections import namedtuple
+from metrics import MetricsLog
+from mutants import mutant_set_from_args, parse_shard, read_mutation_list
+from prediction_cache import PredictionCache
+from structure_store import open_structure_store, pack_predictions
+from workspace import estimate_workspace_bytes, release_ram_workspace, reserve_ram_workspace
 from utils import *
 
 
-def main():
+# resolution of draft movies relative to the selected movie resolution
+DRAFT_SCALE = 0.5
+
+# movie parameters derived from the arguments that are shared by all records
+RenderSettings = namedtuple("RenderSettings", ["movie_width", "movie_height", "scale_factor", "matrix_frame_width", "matrix_margin_horizontal", "matrix_margin_vertical",
+                                               "zoom_factor", "topN", "framerate", "shard", "experimental_mutations", "encoder_profile", "jobs"])
+
+# rough memory of a record process and of each of its PyMOL worker processes before loading any structure
+RECORD_MEMORY = 300 * 2**20
+RENDER_WORKER_MEMORY = 200 * 2**20
+# rough memory of a loaded structure in PyMOL per residue, and of a frame or ray-traced image per pixel (RGBA, with antialiasing)
+STRUCTURE_BYTES_PER_RESIDUE = 10 * 2**10
+FRAME_BYTES_PER_PIXEL = 4
+RAY_BYTES_PER_PIXEL = 16
+# residue pairs within the lDDT cutoff per residue, and frames held in the queues of a streamed movie
+NEIGHBOR_PAIRS_PER_RESIDUE = 20
+QUEUED_FRAMES = 24
+
+
+# arguments that name files or directories, e.g. resolved against the job directory by the render server
+PATH_ARGUMENTS = ["input_fasta", "output_dir", "temp_dir", "prediction_dir", "experimental_dir", "template_script", "mutation_list",
+                  "prediction_cache", "metrics_log", "profile"]
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
                     prog='MutaMoRe',
                     description='Rendering protein mutation movies from predicted 3D structures')
@@ -21,16 +50,232 @@ def main():
     parser.add_argument('-s', '--predictor_script', type=str, dest="template_script", help="Structure prediction script")
     parser.add_argument('-z', '--zoom_factor', type=float, help="Specific zoom level to be used for 3D rendering (optional)")
     parser.add_argument('--top', type=int, help="Only show top-N mutants with structural difference")
+    parser.add_argument('--positions', type=str, help="Only scan mutations at these sequence positions, e.g. 10-50,70 (optional)")
+    parser.add_argument('--targets', type=str, help="Only scan substitutions to these amino acids, e.g. AGP (optional)")
+    parser.add_argument('--mutation_list', type=str, help="File with an explicit list of mutations to scan, one per line, e.g. L32K (optional)")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of parallel worker processes (default: 1)", default=1)
+    parser.add_argument('--draft', action="store_true", help="Render a low-resolution preview movie of a subset of positions with cheaper 3D rendering settings")
+    parser.add_argument('--draft_positions', type=int, help="Number of evenly spaced sequence positions shown in draft mode (default: 20)", default=20)
+    parser.add_argument('--render_batch', type=int, help="Render chunks of N consecutive 3D frames from one multi-state PyMOL object, which reduces the per-frame overhead for small proteins (default: 1)", default=1)
+    parser.add_argument('--parallel_records', type=int, help="Render the movies of up to N records at the same time in separate processes, longest proteins first, sharing the processes of -j (default: 1)", default=1)
+    parser.add_argument('--memory_budget', type=float, help="Only start another record in parallel while the estimated memory of all running records stays below this many GB (optional)")
+    parser.add_argument('--stream', action="store_true", help="Compose frames in memory and stream them directly into ffmpeg instead of writing intermediate PNG files")
+    parser.add_argument('--codec', type=str, help="ffmpeg video codec (default: libx264)", default="libx264")
+    parser.add_argument('--preset', type=str, help="Encoder preset, e.g. ultrafast or slow for libx264 (default: codec default)")
+    parser.add_argument('--crf', type=int, help="Constant rate factor of the encoder, lower values give a higher quality (default: 25)", default=25)
+    parser.add_argument('--encoder_threads', type=int, help="Number of threads of every ffmpeg encoder (default: chosen by ffmpeg)")
+    parser.add_argument('--encode_segments', type=int, help="Encode the movie as N segments in parallel, which are joined without re-encoding (default: 1)", default=1)
+    parser.add_argument('--prediction_cache', type=str, help="Directory of a structure cache shared across runs and proteins, sequences found in the cache are not predicted again (optional)")
+    parser.add_argument('--prediction_shards', type=int, help="Split the structure predictions into N shards run by concurrent predictor instances (default: 1, or one per device)")
+    parser.add_argument('--devices', type=str, help="Comma-separated list of GPU devices assigned round-robin to the prediction shards via CUDA_VISIBLE_DEVICES")
+    parser.add_argument('--watch', action="store_true", help="Score and render predicted structures while the structure predictor is still running")
+    parser.add_argument('--pack_predictions', action="store_true", help="Pack the predicted structures of every protein into a single memory-mapped file and delete the individual PDB files")
+    parser.add_argument('--compact_intermediates', action="store_true", help="Store mutation matrix frames with a shared palette of 256 colors and delete the frames of every stage once they have been used")
+    parser.add_argument('--ram_workspace', type=float, help="Keep the intermediate frames of every movie on the RAM-backed file system (/dev/shm) if they are expected to fit into this many GB, and delete them after encoding (optional)")
+    parser.add_argument('--cleanup', action="store_true", help="Delete the temporary directory after rendering instead of keeping intermediate files for later runs")
+    parser.add_argument('--metrics_log', type=str, help="Append a JSON line with wall time, throughput, peak memory and written bytes of every stage to this file (optional)")
+    parser.add_argument('--profile', type=str, help="Directory for cProfile statistics of every stage (optional)")
+    parser.add_argument('--shard', type=str, help="Only render the k-th of N contiguous slices of the frames of every movie, e.g. 2/4, to be joined with merge_shards.py (optional)")
     parser.add_argument('--only-predict', dest="only_predict", action="store_true", help="Only run structure prediction")
     parser.add_argument('--only-render', dest="only_render", action="store_true", help="Only run movie rendering")
-    args = parser.parse_args()
+    parser.add_argument('--only-score', dest="only_score", action="store_true", help="Only calculate the mutation matrices of predicted structures and write them as tables to the output directory, without rendering")
+    return parser.parse_args(argv)
+
+
+def process_record(args, id, seq, mutants, settings, metrics):
+    """ Renders the movie of one record, with its intermediate files in the RAM
+        workspace if they are expected to fit.
+    """
+    if not args.ram_workspace:
+        render_record(args, id, seq, mutants, settings, metrics, args.temp_dir, args.compact_intermediates)
+        return
+
+    # 3D frames rendered while the structures were predicted (--watch) or in an earlier run are reused
+    rendered_dir = os.path.join(args.temp_dir, id, "draft", "png") if args.draft else os.path.join(args.temp_dir, id, "png")
+    if os.path.isdir(rendered_dir) and any(file_name.endswith(".png") for file_name in os.listdir(rendered_dir)):
+        print("Using the frames of {} that were already rendered in {}".format(id, args.temp_dir))
+        render_record(args, id, seq, mutants, settings, metrics, args.temp_dir, args.compact_intermediates)
+        return
+
+    frames = len(mutants) if settings.topN is None else min(settings.topN, len(mutants))
+    required_bytes = estimate_workspace_bytes(frames, settings.movie_width, settings.movie_height, args.stream)
+    workspace_dir = reserve_ram_workspace(id, required_bytes, args.ram_workspace * 2**30)
+    if workspace_dir is None:
+        print("The intermediate files of {} (about {:.1f} GB) do not fit into the RAM workspace, using {}".format(id, required_bytes / 2**30, args.temp_dir))
+        render_record(args, id, seq, mutants, settings, metrics, args.temp_dir, args.compact_intermediates)
+        return
+    try:
+        # frames are deleted as soon as they have been used to keep the workspace small
+        render_record(args, id, seq, mutants, settings, metrics, workspace_dir, True)
+    finally:
+        release_ram_workspace(workspace_dir)
+
+
+def render_record(args, id, seq, mutants, settings, metrics, tmp_dir, discard_intermediates=False):
+    """ Renders the movie of one record with the mutants selected for it. With
+        discard_intermediates, the frames of every stage are deleted once they
+        have been used.
+    """
+    from render_3d_frames import render_3d_frames, prepare_render_tasks
+    from render_mutation_matrices import render_mutation_matrices, render_matrix_frames
+    from compose_frames import compose_frames
+    from pipeline import render_movie_pipeline
+    from video import FrameEncoder, encode_png_frames
+    from manifest import BuildManifest
 
+    output_dir = args.output_dir
+    prediction_dir = args.prediction_dir
+    movie_width, movie_height, scale_factor = settings.movie_width, settings.movie_height, settings.scale_factor
+    matrix_frame_width, matrix_margin_horizontal, matrix_margin_vertical = settings.matrix_frame_width, settings.matrix_margin_horizontal, settings.matrix_margin_vertical
+    zoom_factor, topN, framerate, shard = settings.zoom_factor, settings.topN, settings.framerate, settings.shard
+    experimental_mutations, encoder_profile = settings.experimental_mutations, settings.encoder_profile
+
+
+    # Prepare directory structure
+
+    current_tmp_dir = os.path.join(tmp_dir, id, "draft") if args.draft else os.path.join(tmp_dir, id)
+    if not os.path.isdir(current_tmp_dir):
+        os.makedirs(current_tmp_dir)
+
+    png_dir = os.path.join(current_tmp_dir, "png")
+    mut_matrices_dir = os.path.join(current_tmp_dir, "mut_matrices_png")
+    composite_dir = os.path.join(current_tmp_dir, "composite_png")
+    if not os.path.isdir(png_dir):
+        os.makedirs(png_dir)
+    if args.stream:
+        # matrix frames and composites are only kept in memory
+        mut_matrices_dir = None
+    else:
+        if not os.path.isdir(mut_matrices_dir):
+            os.makedirs(mut_matrices_dir)
+        if not os.path.isdir(composite_dir):
+            os.makedirs(composite_dir)
+
+    # Intermediate files of previous runs are reused if they are still up to date
+    manifest = BuildManifest(os.path.join(current_tmp_dir, "manifest.json"))
+
+    # Render 3D frames and mutation matrices
+
+    with metrics.stage("mutation_matrices", id, current_tmp_dir) as stage:
+        stage["items"] = len(mutants)
+        topN_indices, matrix_frames = render_mutation_matrices(id, seq, movie_height, prediction_dir, mut_matrices_dir if shard is None else None, width=matrix_frame_width, margin_horiz=matrix_margin_horizontal, margin_vert=matrix_margin_vertical, scale_factor=scale_factor, experimental_mutations=experimental_mutations, experimental_dir=args.experimental_dir, topN=topN, jobs=settings.jobs, manifest=manifest, mutants=mutants, palettize=args.compact_intermediates)
+
+        # all mutants are scored for the top-N selection, but only the frames of this shard are rendered,
+        # numbered as in the full movie
+        first_frame = 0
+        if shard is not None:
+            first_frame, mutants = mutants.shard(topN_indices, shard)
+            topN_indices = None
+            if mut_matrices_dir is not None:
+                render_matrix_frames(id, seq, matrix_frames, mut_matrices_dir, None, manifest, mutants, args.compact_intermediates)
+    movie_name = "{}_draft".format(id) if args.draft else id
+    out_file = os.path.join(output_dir, "{}.mp4".format(movie_name)) if shard is None else shard_movie_file(output_dir, movie_name, shard)
+    frames = len(mutants.selected(topN_indices))
+
+    if args.stream:
+        # Render, compose and encode frames as overlapping stages
+
+        print("Rendering movie for {}".format(id))
+        wt_file = os.path.join(prediction_dir, "{}.pdb".format(id))
+        tasks = prepare_render_tasks(id, seq, prediction_dir, png_dir, movie_width - matrix_frame_width, movie_height, scale_factor, zoom_factor, experimental_mutations, args.experimental_dir, topN_indices, jobs=settings.jobs, mutants=mutants, manifest=manifest, draft=args.draft)
+        with metrics.stage("stream", id, current_tmp_dir) as stage:
+            stage["items"] = frames
+            stage["rendered"] = len(tasks)
+            with FrameEncoder(out_file, movie_width, movie_height, framerate, encoder_profile) as encoder:
+                render_movie_pipeline(tasks, wt_file, movie_width, movie_height, matrix_frame_width, matrix_frames, scale_factor, zoom_factor, encoder, jobs=settings.jobs, keep_3d_frames=False, manifest=manifest, render_batch_size=args.render_batch)
+            stage["output_bytes"] = os.path.getsize(out_file)
+        return
+
+    with metrics.stage("render_3d", id, png_dir) as stage:
+        stage["items"] = frames
+        render_3d_frames(id, seq, prediction_dir, png_dir, movie_width - matrix_frame_width, movie_height, scale_factor, zoom_factor, experimental_mutations, args.experimental_dir, topN_indices, jobs=settings.jobs, mutants=mutants, manifest=manifest, draft=args.draft, batch_size=args.render_batch)
+
+    # Compose final frames
+
+    with metrics.stage("compose", id, composite_dir) as stage:
+        stage["items"] = frames
+        compose_frames(id, seq, movie_width, movie_height, matrix_frame_width, mut_matrices_dir, png_dir, composite_dir, topN_indices, manifest=manifest, mutants=mutants, first_frame=first_frame, trim=shard is None, remove_inputs=discard_intermediates)
+
+    # Render output file
+
+    print("Rendering movie for {}".format(id))
+    start_time = time.time()
+    with metrics.stage("encode", id) as stage:
+        stage["items"] = frames
+        stage["segments"] = args.encode_segments
+        encode_png_frames(composite_dir, framerate, out_file, encoder_profile, args.encode_segments, first_frame=first_frame, frames=frames)
+        if os.path.isfile(out_file):
+            stage["output_bytes"] = os.path.getsize(out_file)
+    if discard_intermediates:
+        for index in range(first_frame, first_frame + frames):
+            composite_file = os.path.join(composite_dir, "{}.png".format(index))
+            if os.path.isfile(composite_file):
+                os.remove(composite_file)
+    end_time = time.time()
+    print("Elapsed time: {}".format(end_time - start_time))
+
+
+def estimate_record_memory(length, width, height, record_jobs):
+    """ Rough peak memory of a record rendered in its own process in bytes,
+        used to decide how many records fit into --memory_budget. It grows with
+        the sequence length through the scoring batches and the structures
+        loaded into PyMOL, and with the resolution through the frames waiting
+        to be composed and the images ray-traced by every worker.
+    """
+    from structure_similarity import SCORING_BATCH_SIZE
+
+    # batch coordinates and the distances, deviations and preserved fractions of all neighbor pairs
+    scoring = SCORING_BATCH_SIZE * length * (3 + 3 * NEIGHBOR_PAIRS_PER_RESIDUE) * 4
+    frames = QUEUED_FRAMES * width * height * FRAME_BYTES_PER_PIXEL
+    worker = 2 * length * STRUCTURE_BYTES_PER_RESIDUE + width * height * RAY_BYTES_PER_PIXEL
+    if record_jobs > 1:
+        return RECORD_MEMORY + scoring + frames + record_jobs * (RENDER_WORKER_MEMORY + worker)
+    # a single process renders the frames itself
+    return RECORD_MEMORY + scoring + frames + worker
+
+
+def render_records_parallel(args, records, settings, metrics):
+    """ Renders several records at the same time, each in its own process with
+        its output written to render.log in its temporary directory. The work of
+        a record is estimated by its number of mutants (19 per residue for a
+        full scan), the largest records are started first.
+    """
+    from scheduler import ScheduledJob, run_longest_first
+
+    start_time = time.time()
+    record_jobs = max(1, args.jobs // args.parallel_records)
+    settings = settings._replace(jobs=record_jobs)
+    memory_budget = args.memory_budget * 2**30 if args.memory_budget else None
+
+    jobs = []
+    for id, seq, mutants in records:
+        record_dir = os.path.join(args.temp_dir, id)
+        if not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+        memory = estimate_record_memory(len(seq), settings.movie_width, settings.movie_height, record_jobs)
+        jobs.append(ScheduledJob(id, len(mutants), memory, process_record, (args, id, seq, mutants, settings, metrics), os.path.join(record_dir, "render.log")))
+
+    print("Rendering {} records, up to {} at a time with {} processes each".format(len(jobs), args.parallel_records, record_jobs))
+    finished = 0
+    for job, exitcode in run_longest_first(jobs, args.parallel_records, memory_budget):
+        finished += 1
+        if exitcode == 0:
+            print("Finished {} ({}/{}), elapsed time: {}".format(job.name, finished, len(jobs), time.time() - start_time))
+        else:
+            print("ERROR: Rendering {} failed, see {}".format(job.name, job.log_file))
+
+
+def run(args):
     input_fasta = args.input_fasta
     output_dir = args.output_dir
     movie_width = args.width
     movie_height = args.height
     tmp_dir = args.temp_dir
     prediction_dir = args.prediction_dir
+    if args.draft:
+        # ffmpeg needs even dimensions for yuv420p
+        movie_width = max(2, int(movie_width * DRAFT_SCALE) // 2 * 2)
+        movie_height = max(2, int(movie_height * DRAFT_SCALE) // 2 * 2)
     
     scale_factor = movie_height / 360
 
@@ -38,27 +283,35 @@ def main():
     matrix_margin_horizontal = int(5 * scale_factor)
     matrix_margin_vertical = int(10 * scale_factor)
     
-    if args.only_predict and args.only_render:
-        print("Please only set either --only-predict or --only-render")
+    if args.only_predict + args.only_render + args.only_score > 1:
+        print("Please only set one of --only-predict, --only-render and --only-score")
     doPredict = True
     doRender = True
+    doScore = False
     if args.only_predict:
         doRender = False
     elif args.only_render:
         doPredict = False
+    elif args.only_score:
+        doPredict = False
+        doRender = False
+        doScore = True
     zoom_factor = None
     if args.zoom_factor:
         zoom_factor = args.zoom_factor
         
     topN = None
-    framerate = 19
     if args.top:
         topN = args.top
-        framerate = topN / 5
-        if framerate < 2:
-            framerate = 2
-        if framerate > 19:
-            framerate = 19
+    framerate = movie_framerate(topN)
+
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            print("ERROR: {}".format(e))
+            quit()
 
     if doPredict and args.template_script is None:
         print("Please select a structure prediction script from the directory 'predictor_scripts/', e.g. using")
@@ -66,11 +319,42 @@ def main():
         quit()
 
     # Check if mutation matrices can be rendered in the selected movie resolution
-    check_movie_resolution(input_fasta, movie_height, matrix_margin_vertical)
+    if doRender:
+        check_movie_resolution(input_fasta, movie_height, matrix_margin_vertical)
     
     if not os.path.isdir(tmp_dir):
         os.makedirs(tmp_dir)
 
+    metrics = MetricsLog(args.metrics_log, args.profile)
+    metrics.event("run", arguments=vars(args))
+
+    # Select the mutants to scan for every input sequence
+    records = []
+    for record in SeqIO.parse(input_fasta, "fasta"):
+        try:
+            records.append((record.id, list(record.seq), mutant_set_from_args(args, record.id, list(record.seq))))
+        except ValueError as e:
+            print("ERROR: {} ({})".format(e, record.id))
+            quit()
+
+    if args.mutation_list:
+        record_ids = set(id for id, seq, mutants in records)
+        for record_id in sorted(set(record_id for record_id, name in read_mutation_list(args.mutation_list) if record_id is not None and record_id not in record_ids)):
+            print("WARNING: The mutation list refers to {}, which is not a record of {}".format(record_id, input_fasta))
+
+    # Records without any mutant in the scan, e.g. with a mutation list that only names other records
+    for id, seq, mutants in records:
+        if len(mutants) == 0:
+            print("Skipping {}, none of its mutations are selected for the scan".format(id))
+    records = [(id, seq, mutants) for id, seq, mutants in records if len(mutants) > 0]
+    if len(records) == 0:
+        print("ERROR: No mutations are selected for the scan, please check --positions, --targets and --mutation_list")
+        quit()
+
+    # Draft movies only show a subset of positions, which also limits the structure predictions
+    if args.draft and topN is None:
+        records = [(id, seq, mutants.sample_positions(args.draft_positions)) for id, seq, mutants in records]
+
     # parse optional experimental structures
     experimental_mutations = None
     if args.experimental_dir:
@@ -88,93 +372,123 @@ def main():
         if not os.path.isdir(prediction_dir):
             os.makedirs(prediction_dir)
 
-        # Create mutated sequences
+        # Create mutated sequences, skipping structures predicted in a previous run
+        entries = []
+        for id, seq, mutants in records:
+            entries.append((id, "".join(seq)))
+            for mutant in mutants:
+                # skip experimental structures
+                if experimental_mutations is not None and mutant.name in experimental_mutations:
+                    continue
+
+                temp_seq = seq.copy()
+                temp_seq[mutant.position] = mutant.aa
+                entries.append(("{}_{}".format(id, mutant.name), "".join(temp_seq)))
+
+        packed = set()
+        for id, seq, mutants in records:
+            store = open_structure_store(id, prediction_dir)
+            if store is not None:
+                packed.update(store.names)
+        missing_entries = [entry for entry in entries if entry[0] not in packed and not os.path.isfile(os.path.join(prediction_dir, entry[0] + ".pdb"))]
+        if len(missing_entries) < len(entries):
+            print("Skipping {} structures that have already been predicted".format(len(entries) - len(missing_entries)))
+
+        # Link structures of sequences predicted in earlier runs, and predict every distinct sequence only once
+        cache = None
+        duplicate_entries = []
+        if args.prediction_cache:
+            cache = PredictionCache(args.prediction_cache, args.template_script)
+            uncached_entries, duplicate_entries = cache.link_cached(missing_entries, prediction_dir)
+            reused = len(missing_entries) - len(uncached_entries) - len(duplicate_entries)
+            if reused > 0:
+                print("Reusing {} structures from the prediction cache".format(reused))
+            if len(duplicate_entries) > 0:
+                print("Skipping {} structures with the same sequence as another structure".format(len(duplicate_entries)))
+            missing_entries = uncached_entries
+
+        # Split sequences into shards with one predictor instance each
+        devices = None
+        shards = args.prediction_shards
+        if args.devices:
+            devices = args.devices.split(",")
+            if shards is None:
+                shards = len(devices)
+        if shards is None:
+            shards = 1
         mutated_fasta = os.path.join(tmp_dir, "mutated_sequences.fasta")
-        with open(mutated_fasta, "w") as f:
-            for record in SeqIO.parse(input_fasta, "fasta"):
-                id = record.id
-                seq = list(record.seq)
-
-                f.write(">{}\n{}\n".format(id, "".join(seq)))
-                for i in range(len(seq)):
-                    for aa in list("ACDEFGHIKLMNPQRSTVWY"):
-                        if aa == seq[i]:
-                            continue
-                        temp_seq = seq.copy()
-                        temp_seq[i] = aa
-                        
-                        # skip experimental structures
-                        mut_name = seq[i] + str(i+1) + aa
-                        if experimental_mutations is not None and mut_name in experimental_mutations:
-                            continue
-
-                        f.write(">{}_{}{}{}\n{}\n".format(id, seq[i], i+1, aa, "".join(temp_seq)))
-
-        # Prepare predictor script
-        predictor_script = os.path.join(tmp_dir, "predictor.sh")
-        prepare_predictor_script(args.template_script, predictor_script, mutated_fasta, prediction_dir)
-
-        # Make script executable
-        st = os.stat(predictor_script)
-        os.chmod(predictor_script, st.st_mode | stat.S_IEXEC)
+        shard_fastas = write_fasta_shards(missing_entries, mutated_fasta, shards)
 
         # Call structure predictor
-        print("Starting structure predictions")
-        os.system("bash -i " + predictor_script)
-
+        processes = []
+        if len(shard_fastas) > 0:
+            print("Starting structure predictions")
+        for k, shard_fasta in enumerate(shard_fastas):
+            predictor_script = os.path.join(tmp_dir, "predictor.sh" if len(shard_fastas) == 1 else "predictor_{}.sh".format(k))
+            device = devices[k % len(devices)] if devices is not None else None
+            processes.append(start_predictor(args.template_script, predictor_script, shard_fasta, prediction_dir, device))
 
-    # Movie rendering
+        with metrics.stage("predict", directory=prediction_dir) as stage:
+            stage["items"] = len(missing_entries)
+            stage["shards"] = len(shard_fastas)
+            if args.watch and doRender:
+                from watch import process_predictions_while_running
 
-    if doRender:
-        from render_3d_frames import render_3d_frames
-        from render_mutation_matrices import render_mutation_matrices
-        from compose_frames import compose_frames
+                process_predictions_while_running(processes, records, prediction_dir, tmp_dir, movie_width - matrix_frame_width, movie_height, scale_factor, zoom_factor, experimental_mutations, topN, jobs=args.jobs, draft=args.draft, render_batch_size=args.render_batch)
+            else:
+                for process in processes:
+                    process.wait()
 
-        for record in SeqIO.parse(input_fasta, "fasta"):
-            id = record.id
-            seq = list(record.seq)
+        if cache is not None:
+            cache.store_predicted(missing_entries, prediction_dir)
+            for name, seq in cache.link_predicted(duplicate_entries, prediction_dir):
+                print("WARNING: No structure was predicted for {}".format(name))
 
-            print("Processing {}".format(id))
+        if args.pack_predictions:
+            for id, seq, mutants in records:
+                count = pack_predictions(id, len(seq), prediction_dir, args.jobs, remove=True)
+                print("Packed {} structures of {}".format(count, id))
 
-            # Prepare directory structure
 
-            current_tmp_dir = os.path.join(tmp_dir, id)
-            if not os.path.isdir(current_tmp_dir):
-                os.makedirs(current_tmp_dir)
+    # Structural similarity tables without rendering
 
-            png_dir = os.path.join(current_tmp_dir, "png")
-            mut_matrices_dir = os.path.join(current_tmp_dir, "mut_matrices_png")
-            composite_dir = os.path.join(current_tmp_dir, "composite_png")
-            if not os.path.isdir(png_dir):
-                os.makedirs(png_dir)
-            if not os.path.isdir(mut_matrices_dir):
-                os.makedirs(mut_matrices_dir)
-            if not os.path.isdir(composite_dir):
-                os.makedirs(composite_dir)
+    if doScore:
+        from score_tables import score_records
 
-            # Render 3D frames and mutation matrices
+        with metrics.stage("score", directory=output_dir) as stage:
+            stage["items"] = len(records)
+            score_records(records, prediction_dir, output_dir, experimental_mutations, args.experimental_dir, topN, jobs=args.jobs)
 
-            topN_indices = render_mutation_matrices(id, seq, movie_height, prediction_dir, mut_matrices_dir, width=matrix_frame_width, margin_horiz=matrix_margin_horizontal, margin_vert=matrix_margin_vertical, scale_factor=scale_factor, experimental_mutations=experimental_mutations, experimental_dir=args.experimental_dir, topN=topN)
-            render_3d_frames(id, seq, prediction_dir, png_dir, movie_width - matrix_frame_width, movie_height, scale_factor, zoom_factor, experimental_mutations, args.experimental_dir, topN_indices)
+    # Movie rendering
 
-            # Compose final frames
+    if doRender:
+        from video import EncoderProfile
 
-            compose_frames(id, seq, movie_width, movie_height, matrix_frame_width, mut_matrices_dir, png_dir, composite_dir, topN_indices)
+        encoder_profile = EncoderProfile(args.codec, args.preset, args.crf, args.encoder_threads)
+        settings = RenderSettings(movie_width, movie_height, scale_factor, matrix_frame_width, matrix_margin_horizontal, matrix_margin_vertical,
+                                  zoom_factor, topN, framerate, shard, experimental_mutations, encoder_profile, args.jobs)
 
-            # Render output file
+        if args.parallel_records > 1 and len(records) > 1:
+            render_records_parallel(args, records, settings, metrics)
+        else:
+            for id, seq, mutants in records:
+                print("Processing {}".format(id))
+                process_record(args, id, seq, mutants, settings, metrics)
 
-            print("Rendering movie for {}".format(id))
-            start_time = time.time()
-            out_file = os.path.join(output_dir, "{}.mp4".format(id))
-            os.system("ffmpeg -y -f image2 -framerate {} -i {}/%d.png -vcodec libx264 -crf 25 -pix_fmt yuv420p {} > /dev/null 2>&1".format(framerate, composite_dir, out_file))
-            end_time = time.time()
-            print("Elapsed time: {}".format(end_time - start_time))
+    metrics.event("done")
 
     # Cleanup
-    print("Done, cleaning up..")
-    shutil.rmtree(tmp_dir)
+    if args.cleanup:
+        print("Done, cleaning up..")
+        shutil.rmtree(tmp_dir)
+    else:
+        print("Done, intermediate files are kept in {} for later runs".format(tmp_dir))
     print("")
 
 
+def main():
+    run(parse_args())
+
+
 if __name__ == "__main__":
     main()
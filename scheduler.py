@@ -0,0 +1,67 @@
+import os
+import sys
+from collections import namedtuple
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+
+
+# work and memory are estimates in arbitrary units and bytes, only used for ordering and admission
+ScheduledJob = namedtuple("ScheduledJob", ["name", "work", "memory", "function", "arguments", "log_file"])
+
+
+def _run_logged(function, arguments, log_file):
+    """ Runs a job with its output, including that of PyMOL and of child
+        processes, redirected to its log file.
+    """
+    with open(log_file, "w") as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        try:
+            function(*arguments)
+        except SystemExit as e:
+            # quit() after an error message
+            sys.stdout.flush()
+            sys.exit(0 if e.code == 0 else 1)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+
+def run_longest_first(jobs, max_parallel, memory_budget=None):
+    """ Runs every job in its own process and yields (job, exit code) as the
+        jobs finish. Jobs with the largest work estimate are started first, so
+        that the last jobs to finish are short ones. A job is only started while
+        fewer than max_parallel jobs are running and the memory estimates of all
+        running jobs fit into memory_budget. If the largest pending job does not
+        fit, smaller jobs are started in its place once. If it still does not fit
+        after the next job has finished, no other job is started until enough
+        memory is free for it, so that it is not pushed to the end by a series of
+        smaller jobs at the cost of leaving some memory unused. A single job is
+        always started, even if it exceeds the budget on its own.
+    """
+    context = get_context("spawn")
+    pending = sorted(jobs, key=lambda job: job.work, reverse=True)
+    running = {}
+    # largest pending job that smaller jobs were already started in place of
+    waiting = None
+    while len(pending) > 0 or len(running) > 0:
+        used = sum(job.memory for job, process in running.values())
+        for job in list(pending):
+            if len(running) >= max_parallel:
+                break
+            if memory_budget is not None and len(running) > 0 and used + job.memory > memory_budget:
+                if job is pending[0]:
+                    if waiting is job:
+                        break
+                    waiting = job
+                continue
+            process = context.Process(target=_run_logged, args=(job.function, job.arguments, job.log_file))
+            process.start()
+            running[process.sentinel] = (job, process)
+            pending.remove(job)
+            used += job.memory
+
+        for sentinel in wait(list(running.keys())):
+            job, process = running.pop(sentinel)
+            process.join()
+            yield job, process.exitcode
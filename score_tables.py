@@ -0,0 +1,111 @@
+import os
+import time
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from mutants import AMINO_ACIDS
+from progressBar import *
+from structure_similarity import get_mutation_matrix
+
+
+SUMMARY_COLUMNS = ["id", "length", "mutants", "min_score", "mean_score", "most_impactful", "status"]
+
+
+def ranked_mutants(mut_matrix, mutants):
+    """ Scanned mutants with their structural similarity to the wild type, the
+        least similar (most impactful) mutants first.
+    """
+    ranked = [(mutant, float(mut_matrix[mutant.cell])) for mutant in mutants]
+    ranked.sort(key=lambda entry: (entry[1], entry[0].position, entry[0].aa))
+    return ranked
+
+
+def write_matrix_table(filename, seq, mut_matrix, mutants):
+    """ Writes the mutation matrix as a tab-separated table with one row per
+        scanned position and one column per amino acid. Cells of the wild-type
+        residue and of mutants that were not scanned are left empty.
+    """
+    cells = set(mutant.cell for mutant in mutants)
+    positions = sorted(set(mutant.position for mutant in mutants))
+    with open(filename, "w") as f:
+        f.write("\t".join(["position", "wt"] + list(AMINO_ACIDS)) + "\n")
+        for i in positions:
+            row = [str(i+1), seq[i]]
+            for a in range(len(AMINO_ACIDS)):
+                row.append("{:.3f}".format(mut_matrix[a, i]) if (a, i) in cells else "")
+            f.write("\t".join(row) + "\n")
+
+
+def write_ranked_table(filename, ranked):
+    with open(filename, "w") as f:
+        f.write("rank\tmutation\tposition\tscore\n")
+        for rank, (mutant, score) in enumerate(ranked, 1):
+            f.write("{}\t{}\t{}\t{:.3f}\n".format(rank, mutant.name, mutant.position+1, score))
+
+
+def score_record(task):
+    """ Scores the mutants of one record and writes its tables. Returns the
+        row of the summary table.
+    """
+    id, seq, mutants, pdb_dir, out_dir, experimental_mutations, experimental_dir, topN, jobs = task
+    summary = {"id": id, "length": len(seq), "mutants": len(mutants), "min_score": "", "mean_score": "", "most_impactful": "", "status": "ok"}
+    try:
+        # progress is only reported for whole records
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            mut_matrix = get_mutation_matrix(id, seq, pdb_dir, experimental_mutations, experimental_dir, jobs=jobs, mutants=mutants)
+    except (OSError, ValueError) as e:
+        summary["status"] = "failed: {}".format(e)
+        return summary
+
+    ranked = ranked_mutants(mut_matrix, mutants)
+    write_matrix_table(os.path.join(out_dir, "{}_matrix.tsv".format(id)), seq, mut_matrix, mutants)
+    write_ranked_table(os.path.join(out_dir, "{}_ranked.tsv".format(id)), ranked[:topN] if topN is not None else ranked)
+    if len(ranked) > 0:
+        summary["min_score"] = "{:.3f}".format(ranked[0][1])
+        summary["mean_score"] = "{:.3f}".format(sum(score for mutant, score in ranked) / len(ranked))
+        summary["most_impactful"] = ranked[0][0].name
+    return summary
+
+
+def score_records(records, pdb_dir, out_dir, experimental_mutations=None, experimental_dir=None, topN=None, jobs=1):
+    """ Calculates the mutation matrices of all records, given as tuples of
+        identifier, sequence and mutant set, without rendering anything. With at
+        least as many records as jobs, the records are distributed over jobs
+        processes, otherwise they are scored one after another with jobs
+        processes parsing the structures of each record. For every record, the
+        matrix (<ID>_matrix.tsv) and the mutants ranked by their structural
+        similarity (<ID>_ranked.tsv, only the top-N if set) are written to
+        out_dir, together with a summary of all records (scores_summary.tsv).
+    """
+    start_time = time.time()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # pool workers cannot start processes of their own, so records scored in parallel use a single process each
+    parallel_records = jobs > 1 and len(records) >= jobs
+    record_jobs = 1 if parallel_records else jobs
+    tasks = [(id, seq, mutants, pdb_dir, out_dir, experimental_mutations, experimental_dir, topN, record_jobs) for id, seq, mutants in records]
+    summaries = []
+    printProgressBar(0, len(tasks), prefix = 'Scoring proteins:', suffix = 'Complete', length = 50)
+    pool = Pool(jobs) if parallel_records else None
+    try:
+        results = pool.imap(score_record, tasks) if pool is not None else map(score_record, tasks)
+        for summary in results:
+            summaries.append(summary)
+            printProgressBar(len(summaries), len(tasks), prefix = 'Scoring proteins:', suffix = 'Complete', length = 50)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with open(os.path.join(out_dir, "scores_summary.tsv"), "w") as f:
+        f.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        for summary in summaries:
+            f.write("\t".join(str(summary[column]) for column in SUMMARY_COLUMNS) + "\n")
+
+    for summary in summaries:
+        if summary["status"] != "ok":
+            print("WARNING: {} could not be scored ({})".format(summary["id"], summary["status"][len("failed: "):]))
+
+    end_time = time.time()
+    print("Elapsed time: {}".format(end_time - start_time))
+    return summaries
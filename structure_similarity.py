@@ -0,0 +1,261 @@
+import csv
+import hashlib
+import os
+import time
+import uuid
+from collections import namedtuple
+import numpy as np
+from scipy.spatial import cKDTree
+from mutants import MutantSet, structure_file
+from pdb_reader import read_ca_coords, read_ca_coords_parallel
+from progressBar import *
+from structure_store import open_structure_store
+
+
+LDDT_CUTOFF = 15.0
+LDDT_THRESHOLDS = (0.5, 1.0, 2.0, 4.0)
+SCORING_BATCH_SIZE = 64
+
+NeighborPairs = namedtuple("NeighborPairs", ["i", "j", "distances", "weights", "isolated", "length"])
+CacheEntry = namedtuple("CacheEntry", ["key", "reference", "size", "mtime_ns", "score"])
+
+
+def neighbor_pairs(ref_coords, cutoff=LDDT_CUTOFF):
+    """ Collects all residue pairs closer than cutoff in the reference structure.
+        Every unordered pair is stored once, its weight combines the per-residue
+        normalization of both residues so that the lDDT reduces to a dot product.
+    """
+    ref_coords = np.asarray(ref_coords, dtype=np.float32)
+    length = len(ref_coords)
+
+    pairs = cKDTree(ref_coords).query_pairs(cutoff, output_type='ndarray')
+    if len(pairs) == 0:
+        pairs = np.zeros((0, 2), dtype=np.intp)
+    idx_i, idx_j = pairs[:, 0], pairs[:, 1]
+    distances = np.linalg.norm(ref_coords[idx_i] - ref_coords[idx_j], axis=-1)
+
+    # query_pairs includes pairs at exactly the cutoff distance
+    inside = distances < cutoff
+    idx_i, idx_j, distances = idx_i[inside], idx_j[inside], distances[inside]
+
+    neighbor_count = np.bincount(idx_i, minlength=length) + np.bincount(idx_j, minlength=length)
+    inverse_count = np.zeros(length, dtype=np.float32)
+    inverse_count[neighbor_count > 0] = 1.0 / neighbor_count[neighbor_count > 0]
+    weights = inverse_count[idx_i] + inverse_count[idx_j]
+
+    # residues without neighbors count as perfectly conserved
+    isolated = int(np.sum(neighbor_count == 0))
+
+    return NeighborPairs(idx_i, idx_j, distances.astype(np.float32), weights.astype(np.float32), isolated, length)
+
+
+def lddt_scores(pairs, coords):
+    """ Computes the lDDT of a batch of structures (B x L x 3) against the
+        reference structure the neighbor pairs were derived from.
+    """
+    coords = np.asarray(coords, dtype=np.float32)
+    if coords.ndim == 2:
+        coords = coords[np.newaxis]
+
+    dist = np.linalg.norm(coords[:, pairs.i] - coords[:, pairs.j], axis=-1)
+    dist_l1 = np.absolute(dist - pairs.distances)
+
+    preserved = np.zeros(dist_l1.shape, dtype=np.float32)
+    for threshold in LDDT_THRESHOLDS:
+        preserved += dist_l1 < threshold
+    preserved *= 1.0 / len(LDDT_THRESHOLDS)
+
+    return (preserved @ pairs.weights + pairs.isolated) / pairs.length
+
+
+def superposition_transforms(mobile, target):
+    """ Kabsch superposition of a batch of structures (B x L x 3) onto the
+        target structure (L x 3). Returns B homogeneous 4x4 transformation
+        matrices that map the mobile coordinates onto the target.
+    """
+    mobile = np.asarray(mobile, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if mobile.ndim == 2:
+        mobile = mobile[np.newaxis]
+
+    mobile_center = mobile.mean(axis=1)
+    target_center = target.mean(axis=0)
+    covariance = np.einsum('bli,lj->bij', mobile - mobile_center[:, np.newaxis], target - target_center)
+
+    u, _, vt = np.linalg.svd(covariance)
+    # correct improper rotations (reflections)
+    d = np.sign(np.linalg.det(np.matmul(u, vt)))
+    vt[:, 2] *= d[:, np.newaxis]
+    rotation = np.matmul(u, vt).transpose(0, 2, 1)
+
+    transforms = np.tile(np.eye(4), (len(mobile), 1, 1))
+    transforms[:, :3, :3] = rotation
+    transforms[:, :3, 3] = target_center - np.einsum('bij,bj->bi', rotation, mobile_center)
+    return transforms
+
+
+def scoring_parameters():
+    return "cutoff={};thresholds={}".format(LDDT_CUTOFF, ",".join(str(t) for t in LDDT_THRESHOLDS))
+
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def similarity_cache_files(id, pdb_dir):
+    matrix_file = os.path.join(pdb_dir, "{}_mutation_matrix.npy".format(id))
+    scores_file = os.path.join(pdb_dir, "{}_mutation_scores.csv".format(id))
+    return matrix_file, scores_file
+
+
+def load_similarity_cache(scores_file):
+    cache = {}
+    if not os.path.isfile(scores_file):
+        return cache
+    with open(scores_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            cache[row["mutation"]] = CacheEntry(row["key"], row["reference"], int(row["size"]), int(row["mtime_ns"]), float(row["score"]))
+    return cache
+
+
+def save_similarity_scores(scores_file, cache):
+    # replaced atomically, since hosts rendering shards of a movie can share the prediction directory
+    tmp_file = "{}.{}.tmp".format(scores_file, uuid.uuid4().hex[:8])
+    with open(tmp_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["mutation", "score", "key", "reference", "size", "mtime_ns"])
+        for mut_name, entry in cache.items():
+            writer.writerow([mut_name, entry.score, entry.key, entry.reference, entry.size, entry.mtime_ns])
+    os.replace(tmp_file, scores_file)
+
+
+def structure_digest(filename, store=None):
+    """ Digest of the PDB file contents, which is the same for packed structures. """
+    name = store.packed_name(filename) if store is not None else None
+    if name is not None:
+        return store.digest(name)
+    return file_digest(filename)
+
+
+def reference_key(wt_file, store=None):
+    return hashlib.sha1("{}:{}".format(scoring_parameters(), structure_digest(wt_file, store)).encode()).hexdigest()
+
+
+def cache_key(filename, reference, cached_entry, store=None):
+    """ Returns the cache key of a mutant structure together with its file stats.
+        The file is only hashed again if its size or modification time changed.
+        Packed structures carry their digest and the stats of the store.
+    """
+    name = store.packed_name(filename) if store is not None else None
+    if name is not None:
+        return hashlib.sha1("{}:{}".format(reference, store.digest(name)).encode()).hexdigest(), os.stat(store.path)
+    st = os.stat(filename)
+    if cached_entry is not None and cached_entry.reference == reference and cached_entry.size == st.st_size and cached_entry.mtime_ns == st.st_mtime_ns:
+        return cached_entry.key, st
+    key = hashlib.sha1("{}:{}".format(reference, file_digest(filename)).encode()).hexdigest()
+    return key, st
+
+
+def read_wild_type(wt_file, seqlen, store=None):
+    """ C-alpha coordinates of the wild type, which all mutants are compared to. """
+    result = read_ca_coords(wt_file, seqlen, store)
+    if result is None:
+        raise ValueError("The wild-type structure {} does not have a C-alpha atom for each of the {} residues of the sequence".format(wt_file, seqlen))
+    return result[0]
+
+
+def score_mutations(id, seq, pdb_dir, mutations, batch_size=SCORING_BATCH_SIZE, jobs=1):
+    """ Calculates the structural similarity of the given mutant structures, a
+        list of (mutation name, PDB file) tuples, to the wild type. Scores are
+        taken from the similarity cache where possible and the cache is updated
+        with all newly calculated scores. Returns a dict of scores by mutation.
+    """
+    store = open_structure_store(id, pdb_dir)
+    wt_file = os.path.join(pdb_dir, "{}.pdb".format(id))
+    wt_c_alpha = read_wild_type(wt_file, len(seq), store)
+    pairs = neighbor_pairs(wt_c_alpha)
+    reference = reference_key(wt_file, store)
+
+    _, scores_file = similarity_cache_files(id, pdb_dir)
+    cache = load_similarity_cache(scores_file)
+    updated_cache = {}
+    scores = {}
+
+    pending = []
+    for mut_name, filename in mutations:
+        cached_entry = cache.get(mut_name)
+        key, st = cache_key(filename, reference, cached_entry, store)
+        if cached_entry is not None and cached_entry.key == key:
+            scores[mut_name] = cached_entry.score
+            if cached_entry.size != st.st_size or cached_entry.mtime_ns != st.st_mtime_ns:
+                updated_cache[mut_name] = cached_entry._replace(size=st.st_size, mtime_ns=st.st_mtime_ns)
+            continue
+        pending.append((mut_name, filename, key, st))
+
+    total = len(mutations)
+    counter = total - len(pending)
+    if total > 0:
+        printProgressBar(counter, total, prefix = 'Calculating structural similarity:', suffix = 'Complete', length = 50)
+
+    batch_coords = np.zeros((batch_size, len(seq), 3), dtype=np.float32)
+    batch_entries = []
+
+    def score_batch():
+        for (mut_name, filename, key, st), score in zip(batch_entries, lddt_scores(pairs, batch_coords[:len(batch_entries)])):
+            scores[mut_name] = float(score)
+            updated_cache[mut_name] = CacheEntry(key, reference, st.st_size, st.st_mtime_ns, float(score))
+        batch_entries.clear()
+
+    for entry, result in zip(pending, read_ca_coords_parallel([entry[1] for entry in pending], len(seq), jobs, store=store)):
+        mut_name, filename, key, st = entry
+        if result is None:
+            print("WARNING: ignoring experimental structure {} since it does not have the same length as the wild-type structure".format(filename))
+            scores[mut_name] = 0.0
+            updated_cache[mut_name] = CacheEntry(key, reference, st.st_size, st.st_mtime_ns, 0.0)
+            continue
+
+        batch_coords[len(batch_entries)] = result[0]
+        batch_entries.append(entry)
+        if len(batch_entries) == batch_size:
+            score_batch()
+
+        counter += 1
+        printProgressBar(counter, total, prefix = 'Calculating structural similarity:', suffix = 'Complete', length = 50)
+
+    if len(batch_entries) > 0:
+        score_batch()
+
+    if len(updated_cache) > 0:
+        cache.update(updated_cache)
+        save_similarity_scores(scores_file, cache)
+
+    return scores
+
+
+def get_mutation_matrix(id, seq, pdb_dir, experimental_mutations, experimental_dir, batch_size=SCORING_BATCH_SIZE, jobs=1, mutants=None):
+    start_time = time.time()
+    if mutants is None:
+        mutants = MutantSet(seq)
+    mut_matrix = np.ones((20, len(seq)))
+
+    cells = {}
+    mutations = []
+    for mutant in mutants:
+        cells[mutant.name] = mutant.cell
+        mutations.append((mutant.name, structure_file(id, mutant, pdb_dir, experimental_mutations, experimental_dir)))
+
+    scores = score_mutations(id, seq, pdb_dir, mutations, batch_size=batch_size, jobs=jobs)
+    for mut_name, score in scores.items():
+        mut_matrix[cells[mut_name]] = score
+
+    matrix_file, _ = similarity_cache_files(id, pdb_dir)
+    np.save(matrix_file, mut_matrix)
+
+    end_time = time.time()
+    print("Elapsed time: {}".format(end_time - start_time))
+
+    return mut_matrix
@@ -0,0 +1,310 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+from multiprocessing import Pool
+import numpy as np
+from manifest import file_signature
+from mutants import parse_mutation
+from pdb_reader import parse_ca_coords
+from progressBar import *
+
+
+MAGIC = b"MUTSTORE"
+VERSION = 1
+HEADER_SIZE = 64
+# index offset, index length and magic at the very end of the file
+TRAILER = struct.Struct("<QQ8s")
+ALIGNMENT = 64
+
+
+def store_file(id, pdb_dir):
+    return os.path.join(pdb_dir, "{}.mutstore".format(id))
+
+
+class StructureStore:
+    """ Read-only view of a packed structure store, a single file holding the
+        structures of a protein and its mutants. It contains the original PDB
+        file contents together with the C-alpha coordinates and B-factors as
+        arrays, which are accessed through memory maps. Entries are named like
+        the PDB files they were packed from, without the .pdb extension, and
+        keep their size and modification time for the build manifests.
+
+        File layout: a header with magic and version, the C-alpha array
+        (N x L x 3, float32), the B-factor array (N x L, float32), the record
+        offsets (N+1, int64), the validity flags (N, uint8), the concatenated
+        PDB records, a JSON index and a trailer pointing to the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a structure store".format(path))
+            version, = struct.unpack("<I", f.read(4))
+            if version != VERSION:
+                raise ValueError("Unsupported structure store version {} in {}".format(version, path))
+            f.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, index_length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError("Truncated structure store {}".format(path))
+            f.seek(index_offset)
+            index = json.loads(f.read(index_length).decode())
+
+        self.seqlen = index["seqlen"]
+        self.names = index["names"]
+        self.digests = index["digests"]
+        self.mtimes_ns = index["mtimes_ns"]
+        self.positions = {name: k for k, name in enumerate(self.names)}
+
+        count = len(self.names)
+        self.ca = np.memmap(path, dtype=np.float32, mode="r", offset=index["ca_offset"], shape=(count, self.seqlen, 3))
+        self.b_factors = np.memmap(path, dtype=np.float32, mode="r", offset=index["b_factors_offset"], shape=(count, self.seqlen))
+        self.record_offsets = np.memmap(path, dtype=np.int64, mode="r", offset=index["record_offsets_offset"], shape=(count + 1,))
+        self.valid = np.memmap(path, dtype=np.uint8, mode="r", offset=index["valid_offset"], shape=(count,))
+        self.records = np.memmap(path, dtype=np.uint8, mode="r", offset=index["records_offset"], shape=(int(self.record_offsets[-1]),))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def packed_name(self, filename):
+        """ Name of the entry standing in for a PDB file next to the store, or
+            None if the file exists on disk (which takes precedence) or is not
+            part of the store.
+        """
+        name = os.path.basename(filename)
+        if not name.endswith(".pdb") or name[:-4] not in self.positions:
+            return None
+        if os.path.dirname(os.path.abspath(filename)) != self.directory or os.path.isfile(filename):
+            return None
+        return name[:-4]
+
+    def ca_coords(self, name, seqlen):
+        """ Same result as pdb_reader.read_ca_coords for the packed structure. """
+        k = self.positions[name]
+        if seqlen != self.seqlen or not self.valid[k]:
+            return None
+        return np.array(self.ca[k]), np.array(self.b_factors[k])
+
+    def digest(self, name):
+        """ SHA-1 of the packed PDB file contents. """
+        return self.digests[self.positions[name]]
+
+    def file_signature(self, name):
+        """ Same signature as manifest.file_signature of the packed PDB file. """
+        k = self.positions[name]
+        return "{}:{}".format(int(self.record_offsets[k+1] - self.record_offsets[k]), self.mtimes_ns[k])
+
+    def pdb_bytes(self, name):
+        k = self.positions[name]
+        return self.records[self.record_offsets[k]:self.record_offsets[k+1]].tobytes()
+
+    def pdb_string(self, name):
+        return self.pdb_bytes(name).decode()
+
+    def export(self, name, filename):
+        with open(filename, "wb") as f:
+            f.write(self.pdb_bytes(name))
+
+
+_open_stores = {}
+
+
+def open_structure_store(id, pdb_dir):
+    """ Returns the structure store of a protein in pdb_dir, or None if there
+        is none. Stores are opened once per process and reopened if they change.
+    """
+    path = store_file(id, pdb_dir)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _open_stores.get(path)
+    if cached is None or cached[0] != mtime_ns:
+        cached = (mtime_ns, StructureStore(path))
+        _open_stores[path] = cached
+    return cached[1]
+
+
+def structure_signature(filename, store=None):
+    """ Signature of a structure for build manifests, also for packed structures. """
+    name = store.packed_name(filename) if store is not None else None
+    if name is not None:
+        return store.file_signature(name)
+    return file_signature(filename)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+_worker_stores = {}
+
+
+def _read_entry(task):
+    name, filename, store_path, seqlen = task
+    if store_path is not None:
+        if store_path not in _worker_stores:
+            _worker_stores[store_path] = StructureStore(store_path)
+        store = _worker_stores[store_path]
+        data = store.pdb_bytes(name)
+        mtime_ns = store.mtimes_ns[store.positions[name]]
+    else:
+        with open(filename, "rb") as f:
+            data = f.read()
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    result = parse_ca_coords(data.decode().splitlines(True), seqlen)
+    return data, hashlib.sha1(data).hexdigest(), mtime_ns, result
+
+
+def pack_structures(path, entries, seqlen, jobs=1, store_path=None):
+    """ Writes a structure store from a list of (name, PDB file) tuples. Entries
+        without a file are copied from the existing store at store_path.
+    """
+    count = len(entries)
+    ca_offset = HEADER_SIZE
+    b_factors_offset = ca_offset + count * seqlen * 3 * 4
+    record_offsets_offset = _align(b_factors_offset + count * seqlen * 4)
+    valid_offset = record_offsets_offset + (count + 1) * 8
+    records_offset = _align(valid_offset + count)
+
+    digests = []
+    mtimes_ns = []
+    record_offsets = np.zeros(count + 1, dtype=np.int64)
+    valid = np.zeros(count, dtype=np.uint8)
+    missing_ca = np.zeros((seqlen, 3), dtype=np.float32)
+    missing_b_factors = np.zeros(seqlen, dtype=np.float32)
+
+    tasks = [(name, filename, store_path if filename is None else None, seqlen) for name, filename in entries]
+    tmp_path = path + ".tmp"
+    printProgressBar(0, count, prefix='Packing structures:', suffix='Complete', length=50)
+    pool = Pool(jobs) if jobs > 1 else None
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", VERSION))
+
+        # all array sizes are known in advance, so every entry is written to its final place right away
+        for k, (data, digest, mtime_ns, result) in enumerate(pool.imap(_read_entry, tasks, 16) if pool is not None else map(_read_entry, tasks)):
+            if result is not None:
+                valid[k] = 1
+            f.seek(ca_offset + k * seqlen * 3 * 4)
+            f.write((result[0] if result is not None else missing_ca).tobytes())
+            f.seek(b_factors_offset + k * seqlen * 4)
+            f.write((result[1] if result is not None else missing_b_factors).tobytes())
+            f.seek(records_offset + int(record_offsets[k]))
+            f.write(data)
+            record_offsets[k+1] = record_offsets[k] + len(data)
+            digests.append(digest)
+            mtimes_ns.append(mtime_ns)
+            printProgressBar(k+1, count, prefix='Packing structures:', suffix='Complete', length=50)
+
+        f.seek(record_offsets_offset)
+        f.write(record_offsets.tobytes())
+        f.write(valid.tobytes())
+
+        index_offset = records_offset + int(record_offsets[-1])
+        index = json.dumps({"seqlen": seqlen, "names": [name for name, filename in entries], "digests": digests, "mtimes_ns": mtimes_ns,
+                            "ca_offset": ca_offset, "b_factors_offset": b_factors_offset, "record_offsets_offset": record_offsets_offset,
+                            "valid_offset": valid_offset, "records_offset": records_offset}).encode()
+        f.seek(index_offset)
+        f.write(index)
+        f.write(TRAILER.pack(index_offset, len(index), MAGIC))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    os.replace(tmp_path, path)
+
+
+def predicted_structures(id, pdb_dir):
+    """ Lists the PDB files of a protein and its mutants in pdb_dir as tuples of
+        entry name and file name, the wild type first.
+    """
+    entries = []
+    wt_file = os.path.join(pdb_dir, "{}.pdb".format(id))
+    if os.path.isfile(wt_file):
+        entries.append((id, wt_file))
+    prefix = id + "_"
+    for file_name in sorted(os.listdir(pdb_dir)):
+        if not file_name.startswith(prefix) or not file_name.endswith(".pdb"):
+            continue
+        mut_name = file_name[len(prefix):-4]
+        try:
+            parse_mutation(mut_name)
+        except ValueError:
+            continue
+        entries.append((file_name[:-4], os.path.join(pdb_dir, file_name)))
+    return entries
+
+
+def pack_predictions(id, seqlen, pdb_dir, jobs=1, remove=False):
+    """ Packs the predicted structures of a protein into its structure store,
+        keeping all entries of an existing store that are not on disk. With
+        remove, the packed PDB files are deleted afterwards.
+    """
+    entries = predicted_structures(id, pdb_dir)
+    store = open_structure_store(id, pdb_dir)
+    if store is not None:
+        on_disk = set(name for name, filename in entries)
+        entries += [(name, None) for name in store if name not in on_disk]
+    if len(entries) == 0:
+        return 0
+
+    pack_structures(store_file(id, pdb_dir), entries, seqlen, jobs, store.path if store is not None else None)
+    if remove:
+        for name, filename in entries:
+            if filename is not None:
+                os.remove(filename)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='structure_store',
+                    description='Packing predicted structures into one memory-mapped file per protein and exporting them again')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = subparsers.add_parser("pack", help="Pack the predicted structures of all sequences of a FASTA file")
+    pack_parser.add_argument('-i', '--input_fasta', type=str, help="Input FASTA file", required=True)
+    pack_parser.add_argument('-p', '--prediction_dir', type=str, help="Directory with predicted structures (default: ./tmp/predictions)", default="./tmp/predictions")
+    pack_parser.add_argument('-j', '--jobs', type=int, help="Number of parallel worker processes (default: 1)", default=1)
+    pack_parser.add_argument('--remove', action="store_true", help="Delete the PDB files after packing them")
+
+    export_parser = subparsers.add_parser("export", help="Export packed structures as PDB files")
+    export_parser.add_argument('store', type=str, help="Structure store file")
+    export_parser.add_argument('-o', '--output_dir', type=str, help="Output directory for the PDB files (default: current working directory)", default="./")
+    export_parser.add_argument('-n', '--names', type=str, nargs="+", help="Entries to export, e.g. P12345_L32K (default: all)")
+
+    list_parser = subparsers.add_parser("list", help="List the entries of a structure store")
+    list_parser.add_argument('store', type=str, help="Structure store file")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        from Bio import SeqIO
+
+        for record in SeqIO.parse(args.input_fasta, "fasta"):
+            count = pack_predictions(record.id, len(record.seq), args.prediction_dir, args.jobs, args.remove)
+            print("Packed {} structures of {}".format(count, record.id))
+    elif args.command == "export":
+        store = StructureStore(args.store)
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        for name in args.names or store.names:
+            if name not in store:
+                print("ERROR: {} is not contained in {}".format(name, args.store))
+                quit()
+            store.export(name, os.path.join(args.output_dir, name + ".pdb"))
+    elif args.command == "list":
+        store = StructureStore(args.store)
+        for name in store:
+            print(name)
+
+
+if __name__ == "__main__":
+    main()
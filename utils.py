@@ -1,35 +1,55 @@
 from Bio import SeqIO
+from functools import lru_cache
+from PIL import ImageFont
 import os
-import sys
+import stat
+import subprocess
+
+
+# intermediate frames are written with fast compression, they are read back only once
+INTERMEDIATE_PNG_COMPRESSION = 1
 
 
 def get_script_path():
-    return os.path.dirname(os.path.realpath(sys.argv[0]))
+    return os.path.dirname(os.path.realpath(__file__))
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    """ Loads the bundled font once per size and process. """
+    return ImageFont.truetype(os.path.join(get_script_path(), "font.ttf"), size)
+
+
+def movie_framerate(topN=None):
+    """ Frames per second, movies of only the top-N mutants are played slower. """
+    if topN is None:
+        return 19
+    return min(max(topN / 5, 2), 19)
+
+
+def shard_movie_file(output_dir, id, shard):
+    return os.path.join(output_dir, "{}_shard{}of{}.mp4".format(id, *shard))
 
 
 def check_movie_resolution(input_fasta, movie_height, matrix_margin_vertical):
+    """ Informs about proteins that are longer than the number of pixel rows
+        available for the mutation matrix. Their residues are pooled into rows
+        and every frame shows a zoomed inset around the current position.
+    """
     print("Checking protein lengths in input file..")
+    available_rows = movie_height - 2 * matrix_margin_vertical
     total_min_height = 0
     for record in SeqIO.parse(input_fasta, "fasta"):
         id = record.id
         seq = list(record.seq)
         min_height = len(seq) + 2 * matrix_margin_vertical
         if min_height > movie_height:
-            print("You will need a vertical resolution of at least {} to render the protein with identifier {}".format(min_height, id))
+            print("The mutation matrix of {} pools {:.1f} residues per pixel row, showing the lowest similarity of each row, plus a zoomed inset around the current position".format(id, len(seq) / available_rows))
             if min_height > total_min_height:
                 total_min_height = min_height
     if total_min_height != 0:
+        print("To show one row per residue for all sequences in your input file, you would need a vertical resolution of at least {}.".format(total_min_height))
         print("")
-        print("To render all sequences in your input file, you would need a vertical resolution of at least {}.".format(total_min_height))
-        if total_min_height <= 1080:
-            print("Consider rendering in Full-HD by passing the command line arguments: --width 1920 --height 1080")
-        elif total_min_height <= 2160:
-            print("Consider rendering in 4K resolution by passing the command line arguments: --width 3840 --height 2160")
-            print("This will take a while and use a lot of disk space. Instead, consider removing the longest sequences from your input file.")
-        else:
-            print("You seem to have particularly long proteins in your input file! You can try setting a movie resolution as indicated above, but rendering times and disk space requirements will be massive.")
-            print("Consider removing particulary long sequences from your input file.")
-        quit()
 
 
 def prepare_predictor_script(template_script, output_script, input_file, output_dir):
@@ -37,3 +57,41 @@ def prepare_predictor_script(template_script, output_script, input_file, output_
         with open(output_script, "w") as f_out:
             for line in f_in:
                 f_out.write(line.replace("MUTAMORE_INPUT", input_file).replace("MUTAMORE_OUTPUT", output_dir))
+
+
+def write_fasta_shards(entries, fasta_file, shards):
+    """ Distributes (name, sequence) entries round-robin over up to shards FASTA
+        files and returns the list of written files. A single shard is written
+        to fasta_file itself.
+    """
+    shards = max(1, min(shards, len(entries)))
+    if len(entries) == 0:
+        return []
+    if shards == 1:
+        shard_files = [fasta_file]
+    else:
+        base, ext = os.path.splitext(fasta_file)
+        shard_files = ["{}_{}{}".format(base, k, ext) for k in range(shards)]
+
+    for k, shard_file in enumerate(shard_files):
+        with open(shard_file, "w") as f:
+            for name, seq in entries[k::shards]:
+                f.write(">{}\n{}\n".format(name, seq))
+    return shard_files
+
+
+def start_predictor(template_script, predictor_script, input_file, output_dir, device=None):
+    """ Prepares the predictor script for one input file and starts it in the
+        background, optionally restricted to a single GPU device.
+    """
+    prepare_predictor_script(template_script, predictor_script, input_file, output_dir)
+
+    # Make script executable
+    st = os.stat(predictor_script)
+    os.chmod(predictor_script, st.st_mode | stat.S_IEXEC)
+
+    env = None
+    if device is not None:
+        env = dict(os.environ)
+        env["CUDA_VISIBLE_DEVICES"] = str(device)
+    return subprocess.Popen(["bash", "-i", predictor_script], env=env)
@@ -0,0 +1,119 @@
+import os
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+EncoderProfile = namedtuple("EncoderProfile", ["codec", "preset", "crf", "threads"])
+
+DEFAULT_PROFILE = EncoderProfile("libx264", None, 25, None)
+
+
+def encoder_options(profile):
+    """ ffmpeg output options of an encoder profile. Options set to None are
+        left to the ffmpeg defaults of the codec.
+    """
+    options = ["-vcodec", profile.codec]
+    if profile.preset is not None:
+        options += ["-preset", profile.preset]
+    if profile.crf is not None:
+        options += ["-crf", str(profile.crf)]
+    if profile.threads is not None:
+        options += ["-threads", str(profile.threads)]
+    return options + ["-pix_fmt", "yuv420p"]
+
+
+def run_ffmpeg(arguments, out_file):
+    result = subprocess.run(["ffmpeg", "-y"] + arguments + [out_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        message = result.stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError("ffmpeg failed to encode {}: {}".format(out_file, message[-1] if len(message) > 0 else "unknown error"))
+
+
+def count_png_frames(composite_dir, first_frame=0):
+    count = 0
+    while os.path.isfile(os.path.join(composite_dir, "{}.png".format(first_frame + count))):
+        count += 1
+    return count
+
+
+def concat_movies(movie_files, out_file):
+    """ Joins movies encoded with the same encoder profile without re-encoding.
+        Every movie starts with a key frame, so the concat demuxer can copy the
+        streams.
+    """
+    list_file = out_file + ".parts.txt"
+    try:
+        with open(list_file, "w") as f:
+            for movie_file in movie_files:
+                f.write("file '{}'\n".format(os.path.abspath(movie_file).replace("'", "'\\''")))
+        run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy"], out_file)
+    finally:
+        if os.path.isfile(list_file):
+            os.remove(list_file)
+
+
+def encode_png_frames(composite_dir, framerate, out_file, profile=DEFAULT_PROFILE, segments=1, first_frame=0, frames=None):
+    """ Encodes the numbered PNG frames of composite_dir into a movie, by
+        default all consecutive frames starting at first_frame. With
+        segments > 1, contiguous frame ranges are encoded concurrently into
+        separate files, which are then joined without re-encoding.
+    """
+    if frames is None:
+        frames = count_png_frames(composite_dir, first_frame)
+    segments = max(1, min(segments, frames))
+    if segments == 1:
+        run_ffmpeg(["-f", "image2", "-framerate", str(framerate), "-start_number", str(first_frame), "-i", os.path.join(composite_dir, "%d.png"),
+                    "-frames:v", str(frames)] + encoder_options(profile), out_file)
+        return
+
+    boundaries = [first_frame + frames * k // segments for k in range(segments + 1)]
+    segment_files = ["{}.part{}.mp4".format(out_file, k) for k in range(segments)]
+
+    def encode_segment(k):
+        run_ffmpeg(["-f", "image2", "-framerate", str(framerate), "-start_number", str(boundaries[k]), "-i", os.path.join(composite_dir, "%d.png"),
+                    "-frames:v", str(boundaries[k+1] - boundaries[k])] + encoder_options(profile), segment_files[k])
+
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            for _ in executor.map(encode_segment, range(segments)):
+                pass
+        concat_movies(segment_files, out_file)
+    finally:
+        for filename in segment_files:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+
+class FrameEncoder:
+    """ Encodes frames into a movie by piping raw RGB data into ffmpeg. """
+
+    def __init__(self, out_file, width, height, framerate, profile=DEFAULT_PROFILE):
+        self.out_file = out_file
+        self.width = width
+        self.height = height
+        command = ["ffmpeg", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(width, height), "-framerate", str(framerate), "-i", "-"]
+        command += encoder_options(profile) + [out_file]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def write(self, img):
+        if img.size != (self.width, self.height):
+            raise ValueError("Frame size {}x{} does not match the movie resolution {}x{}".format(img.size[0], img.size[1], self.width, self.height))
+        self.process.stdin.write(img.convert("RGB").tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to encode {}".format(self.out_file))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.process.kill()
+            self.process.wait()
+            return False
+        self.close()
+        return False
@@ -0,0 +1,104 @@
+import os
+import time
+
+
+def wait_for_files(processes, directory, expected_files, poll_interval=10.0):
+    """ Yields lists of newly completed files out of expected_files (in their
+        original order) while the given processes are running. A file counts as
+        complete once its size did not change between two polls. Stops when all
+        files are complete or all processes have exited.
+    """
+    remaining = list(expected_files)
+    sizes = {}
+    while len(remaining) > 0:
+        running = any(process.poll() is None for process in processes)
+
+        current_sizes = {}
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                current_sizes[entry.path] = entry.stat().st_size
+
+        ready = []
+        for filename in remaining:
+            size = current_sizes.get(os.path.join(directory, os.path.basename(filename)), 0)
+            # files no longer change once all writers have exited
+            if size > 0 and (not running or sizes.get(filename) == size):
+                ready.append(filename)
+            sizes[filename] = size
+
+        if len(ready) > 0:
+            ready_set = set(ready)
+            remaining = [filename for filename in remaining if filename not in ready_set]
+            yield ready
+
+        if not running:
+            break
+        time.sleep(poll_interval)
+
+
+def process_predictions_while_running(processes, records, prediction_dir, tmp_dir, width, height, scale_factor, zoom_factor=None, experimental_mutations=None, topN=None, jobs=1, poll_interval=10.0, draft=False, render_batch_size=1):
+    """ Scores the predicted mutant structures of all records, given as tuples
+        of identifier, sequence and mutant set, as they appear in the prediction
+        directory and, unless only the top-N mutants are rendered, renders their
+        3D frames. Scores end up in the similarity cache and frames in the usual
+        png directory, where the rendering stages pick them up. Draft frames are
+        kept in a separate directory.
+    """
+    from manifest import BuildManifest
+    from mutants import MutantSet, structure_file
+    from structure_similarity import score_mutations
+    from render_3d_frames import prepare_render_tasks, render_tasks
+    from structure_store import open_structure_store
+
+    # packed structures are not predicted again, they are processed by the regular rendering stages
+    expected_files = []
+    completed = set()
+    mutations = {}
+    for id, seq, mutants in records:
+        store = open_structure_store(id, prediction_dir)
+        wt_file = os.path.join(prediction_dir, "{}.pdb".format(id))
+        if store is not None and store.packed_name(wt_file) is not None:
+            completed.add(wt_file)
+        else:
+            expected_files.append(wt_file)
+        for mutant in mutants:
+            if experimental_mutations is not None and mutant.name in experimental_mutations:
+                continue
+            filename = structure_file(id, mutant, prediction_dir)
+            if store is not None and store.packed_name(filename) is not None:
+                continue
+            expected_files.append(filename)
+            mutations[filename] = (id, mutant.name)
+
+    pending = {id: [] for id, seq, mutants in records}
+    for ready in wait_for_files(processes, prediction_dir, expected_files, poll_interval):
+        completed.update(ready)
+        for filename in ready:
+            if filename in mutations:
+                id, mut_name = mutations[filename]
+                pending[id].append((mut_name, filename))
+
+        for id, seq, mutants in records:
+            wt_file = os.path.join(prediction_dir, "{}.pdb".format(id))
+            if wt_file not in completed or len(pending[id]) == 0:
+                continue
+            ready_mutations = pending[id]
+            pending[id] = []
+
+            print("Processing {} new predictions for {}".format(len(ready_mutations), id))
+            score_mutations(id, seq, prediction_dir, ready_mutations, jobs=jobs)
+
+            # the top-N selection needs the scores of all mutants
+            if topN is not None:
+                continue
+            current_tmp_dir = os.path.join(tmp_dir, id, "draft") if draft else os.path.join(tmp_dir, id)
+            png_dir = os.path.join(current_tmp_dir, "png")
+            if not os.path.isdir(png_dir):
+                os.makedirs(png_dir)
+            manifest = BuildManifest(os.path.join(current_tmp_dir, "manifest.json"))
+            tasks = prepare_render_tasks(id, seq, prediction_dir, png_dir, width, height, scale_factor, zoom_factor, experimental_mutations, jobs=jobs, mutants=MutantSet(seq, mutations=[mut_name for mut_name, filename in ready_mutations]), manifest=manifest, draft=draft)
+            for task in render_tasks(tasks, wt_file, width, height, scale_factor, zoom_factor, jobs, window=len(tasks), manifest=manifest, batch_size=render_batch_size):
+                pass
+
+    for process in processes:
+        process.wait()
@@ -0,0 +1,85 @@
+import fcntl
+import glob
+import os
+import shutil
+from metrics import directory_size
+
+
+RAM_DIR = "/dev/shm"
+# rough size of an intermediate 3D or composite frame with fast PNG compression
+FRAME_BYTES_PER_PIXEL = 1.0
+
+
+def ram_workspace_root():
+    return os.path.join(RAM_DIR, "mutamore-{}".format(os.getuid()))
+
+
+def estimate_workspace_bytes(frames, width, height, stream=False):
+    """ Estimated peak size of the intermediate files of a movie. Mutation
+        matrix frames are small in comparison and not included. Streamed movies
+        only keep the 3D frames until they are composed.
+    """
+    per_frame = width * height * FRAME_BYTES_PER_PIXEL
+    return int(frames * per_frame * (1 if stream else 2))
+
+
+def _process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _reserved_bytes(root):
+    """ Sum of the reservations of running records. Reservations left behind by
+        killed processes are removed.
+    """
+    reserved = 0
+    for reservation_file in glob.glob(os.path.join(glob.escape(root), "*.reserved")):
+        workspace_dir = reservation_file[:-len(".reserved")]
+        pid = workspace_dir.rsplit("_", 1)[-1]
+        if pid.isdigit() and not _process_running(int(pid)):
+            release_ram_workspace(workspace_dir)
+            continue
+        with open(reservation_file, "r") as f:
+            reserved += int(f.read().strip() or 0)
+    return reserved
+
+
+def reserve_ram_workspace(id, required_bytes, cap_bytes):
+    """ Creates a temporary directory for a record on the RAM-backed file
+        system if its intermediate files are expected to fit next to those of
+        other running records, both within cap_bytes and the free memory.
+        Returns None otherwise, or if there is no RAM-backed file system. The
+        expected size is reserved in <workspace>.reserved under a lock, so that
+        records started at the same time cannot exceed the cap together.
+    """
+    if not os.path.isdir(RAM_DIR):
+        return None
+    root = ram_workspace_root()
+    if not os.path.isdir(root):
+        os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "reservations.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        reserved = _reserved_bytes(root)
+        # reserved space that has not been written yet is still counted as free
+        unwritten = max(0, reserved - directory_size(root))
+        if reserved + required_bytes > cap_bytes or unwritten + required_bytes > shutil.disk_usage(RAM_DIR).free:
+            return None
+        workspace_dir = os.path.join(root, "{}_{}".format(id, os.getpid()))
+        if not os.path.isdir(workspace_dir):
+            os.makedirs(workspace_dir)
+        with open(workspace_dir + ".reserved", "w") as f:
+            f.write("{}\n".format(required_bytes))
+    return workspace_dir
+
+
+def release_ram_workspace(workspace_dir):
+    shutil.rmtree(workspace_dir, ignore_errors=True)
+    try:
+        os.remove(workspace_dir + ".reserved")
+    except FileNotFoundError:
+        pass